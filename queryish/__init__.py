@@ -1,17 +1,138 @@
+from concurrent.futures import ThreadPoolExecutor
+import contextvars
 import copy
+import hashlib
+import heapq
+import itertools
 import re
 
+from queryish.aggregates import Avg, Count, Max, Min, Sum  # noqa: F401
+from queryish.cache import (  # noqa: F401
+    CacheScope, IdentityMap, ResultCache, cache_scope, get_current_scope
+)
+from queryish.storage import LazyRowList, ResultListView, SpillingResultList
+
+_missing = object()
+
+
+def make_hashable(val):
+    # convert a filter value into a hashable equivalent, for use in query keys
+    if isinstance(val, (list, tuple)):
+        return tuple(make_hashable(item) for item in val)
+    elif isinstance(val, (set, frozenset)):
+        return frozenset(make_hashable(item) for item in val)
+    elif isinstance(val, dict):
+        return tuple(sorted((key, make_hashable(item)) for key, item in val.items()))
+    return val
+
+
+def get_numpy_dtype(values, current=None):
+    """
+    Return the NumPy dtype for storing a list of field values: int64 or float64 for
+    numbers, bool for booleans, or object for anything else (including None). `current`
+    is the dtype chosen for earlier values of the field, which is widened if necessary.
+    """
+    import numpy as np
+
+    types = {type(value) for value in values}
+    if not types:
+        return current or np.dtype(object)
+    elif types == {bool}:
+        dtype = np.dtype(bool)
+    elif types == {int}:
+        dtype = np.dtype(np.int64)
+    elif types <= {int, float}:
+        dtype = np.dtype(np.float64)
+    else:
+        dtype = np.dtype(object)
+
+    if current is None or current == dtype:
+        return dtype
+    elif {current, dtype} == {np.dtype(np.int64), np.dtype(np.float64)}:
+        return np.dtype(np.float64)
+    return np.dtype(object)
+
+
+def get_canonical_form(val):
+    # a string representation of a hashable query key value that is independent of
+    # hash randomisation: set members are sorted, and values are tagged with their type
+    if isinstance(val, tuple):
+        return "tuple(%s)" % ",".join(get_canonical_form(item) for item in val)
+    elif isinstance(val, frozenset):
+        return "set(%s)" % ",".join(sorted(get_canonical_form(item) for item in val))
+    return "%s:%r" % (type(val).__qualname__, val)
+
+
+class FilterChain:
+    """
+    An immutable sequence of (key, value) filter tuples, stored as a linked list so that
+    adding a filter returns a new chain sharing all existing entries with the original.
+    """
+    __slots__ = ("parent", "item", "length", "_items")
+
+    def __init__(self, parent=None, item=None):
+        self.parent = parent
+        self.item = item
+        self.length = 0 if parent is None else parent.length + 1
+        self._items = None
+
+    def add(self, key, val):
+        return FilterChain(self, (key, val))
+
+    @property
+    def items(self):
+        # a hashable tuple of the filters, computed on first access
+        if self._items is None:
+            self._items = tuple((key, make_hashable(val)) for key, val in self)
+        return self._items
+
+    def __iter__(self):
+        node = self
+        items = []
+        while node.parent is not None:
+            items.append(node.item)
+            node = node.parent
+        return reversed(items)
+
+    def __len__(self):
+        return self.length
+
+    def __eq__(self, other):
+        if isinstance(other, FilterChain):
+            return self is other or self.items == other.items
+        return NotImplemented
+
+    def __hash__(self):
+        return hash(self.items)
+
+    def __repr__(self):
+        return "<FilterChain %r>" % list(self)
+
 
 class Queryish:
+    model = None
+    result_cache = None
+    result_cache_as_rows = False
+    prefetch_batch_size = 100
+    max_results_in_memory = None
+    supports_descending_ordering = False
+    refresh_cache = False
+    warm_queries = ()
+
     def __init__(self):
         self._results = None
+        self._result_iterator = None
+        self._result_prefix = None
         self._count = None
         self.offset = 0
         self.limit = None
-        self.filters = []
+        self.filters = FilterChain()
         self.filter_fields = None
         self.ordering = ()
         self.ordering_fields = None
+        self.only_fields = None
+        self.deferred_fields = ()
+        self.prefetch_related_lookups = ()
 
     def run_query(self):
         raise NotImplementedError
@@ -22,41 +143,390 @@ class Queryish:
             count += 1
         return count
 
+    def stream_record_pages(self, page_size=1000):
+        """
+        Yield the records of this queryset as a sequence of lists, in a single pass and
+        without populating the result cache. Used for computing aggregates and for
+        columnar output.
+        """
+        if self._results is not None:
+            results = self._results
+        else:
+            results = self.run_query()
+        if isinstance(results, list):
+            for i in range(0, len(results), page_size):
+                yield results[i:i + page_size]
+        else:
+            iterator = iter(results)
+            while True:
+                page = list(itertools.islice(iterator, page_size))
+                if not page:
+                    return
+                yield page
+
+    def stream_records(self):
+        for page in self.stream_record_pages():
+            yield from page
+
+    def get_record_value(self, record, field):
+        if isinstance(record, dict):
+            return record.get(field)
+        return getattr(record, field, None)
+
+    def aggregate(self, *args, **kwargs):
+        aggregates = {}
+        for aggregate in args:
+            aggregates[aggregate.default_alias] = aggregate
+        aggregates.update(kwargs)
+        return self.run_aggregate(aggregates)
+
+    def run_aggregate(self, aggregates):
+        if all(getattr(aggregate, "counts_rows", False) for aggregate in aggregates.values()):
+            # only row counts are required, so take advantage of any optimised count() logic
+            count = self.count()
+            return {alias: count for alias in aggregates}
+
+        accumulators = [
+            (aggregate.field, aggregate.get_accumulator())
+            for aggregate in aggregates.values()
+        ]
+        for record in self.stream_records():
+            for field, accumulator in accumulators:
+                if field == "*":
+                    accumulator.add(True)
+                else:
+                    accumulator.add(self.get_record_value(record, field))
+
+        return {
+            alias: accumulator.result()
+            for alias, (field, accumulator) in zip(aggregates, accumulators)
+        }
+
+    def to_columns(self, fields, dtypes=None):
+        """
+        Return a dict mapping each of the given field names to a NumPy array of the values
+        of that field across the queryset, with dtypes chosen as for to_numpy().
+        """
+        array = self.to_numpy(fields, dtypes=dtypes)
+        return {field: array[field] for field in fields}
+
+    def to_numpy(self, fields, dtypes=None):
+        """
+        Return the values of the given fields as a NumPy structured array. `dtypes` is an
+        optional dict mapping field names to the NumPy dtypes to use; other fields are
+        stored as integers, floats or booleans where all of their values allow it, and as
+        Python objects otherwise. The array is allocated once the first page of results
+        has been fetched, sized from the count reported with it where available, and
+        filled a page at a time.
+        """
+        import numpy as np
+
+        dtypes = dtypes or {}
+
+        def get_columns(page):
+            return {
+                field: [self.get_record_value(record, field) for record in page]
+                for field in fields
+            }
+
+        pages = iter(self.stream_record_pages())
+        page = next(pages, [])
+        columns = get_columns(page)
+        dtype = np.dtype([
+            (field, dtypes[field] if field in dtypes else get_numpy_dtype(columns[field]))
+            for field in fields
+        ])
+        # fetching the first page records the size of the result set where the source
+        # reports it, so count() (which may make a separate request) is not needed
+        if self._results is not None:
+            capacity = len(self._results)
+        elif self._count is not None:
+            capacity = self._count
+        else:
+            capacity = len(page)
+        array = np.empty(max(capacity, len(page)), dtype=dtype)
+
+        size = 0
+        while page:
+            if size + len(page) > len(array):
+                # the size was not known up front; double the capacity, so that the array
+                # is copied O(log n) times
+                array = np.resize(array, max(size + len(page), len(array) * 2))
+            for field, values in columns.items():
+                if field not in dtypes:
+                    field_dtype = get_numpy_dtype(values, array.dtype[field])
+                    if field_dtype != array.dtype[field]:
+                        # this page has values that do not fit the type inferred so far
+                        array = array.astype([
+                            (name, field_dtype if name == field else array.dtype[name])
+                            for name in fields
+                        ])
+                array[field][size:size + len(page)] = values
+            size += len(page)
+            page = next(pages, [])
+            columns = get_columns(page)
+        return array[:size]
+
+    def to_arrow(self, fields, schema=None):
+        """
+        Return the values of the given fields as a PyArrow table, built from one record
+        batch per page of results.
+        """
+        import pyarrow as pa
+
+        batches = []
+        for page in self.stream_record_pages():
+            batch = pa.RecordBatch.from_pydict({
+                field: [self.get_record_value(record, field) for record in page]
+                for field in fields
+            }, schema=schema)
+            if schema is None:
+                schema = batch.schema
+            batches.append(batch)
+        if not batches:
+            return pa.table({field: [] for field in fields}, schema=schema)
+        return pa.Table.from_batches(batches, schema=schema)
+
+    def distinct_values(self, field):
+        seen = set()
+        values = []
+        for record in self.stream_records():
+            value = self.get_record_value(record, field)
+            if value not in seen:
+                seen.add(value)
+                values.append(value)
+        return values
+
     def __iter__(self):
         if self._results is None:
+            self._results = self.get_cached_results()
+        if self._results is not None:
+            yield from self._results
+            return
+
+        if self._result_iterator is None:
             results = self.run_query()
+            if self.prefetch_related_lookups:
+                results = self.iter_with_prefetched_objects(results)
             if isinstance(results, list):
                 self._results = results
-                for result in results:
-                    yield result
+                self.set_cached_results(results)
+                yield from results
+                return
+            self._result_iterator = iter(results)
+            self._result_prefix = self.new_result_list()
+
+        # Yield from the results consumed so far, then continue consuming the underlying
+        # iterator. The consumed results are kept in _result_prefix so that if this
+        # iteration stops early, a subsequent one can resume where it left off.
+        prefix = self._result_prefix
+        i = 0
+        while True:
+            if i < len(prefix):
+                result = prefix[i]
             else:
-                results_list = []
-                for result in results:
-                    results_list.append(result)
-                    yield result
-                self._results = results_list
+                result = self._consume_result()
+                if result is _missing:
+                    return
+            yield result
+            i += 1
+
+    def new_result_list(self):
+        if self.max_results_in_memory is None:
+            return []
+        return SpillingResultList(self.max_results_in_memory)
+
+    def _consume_result(self):
+        # Fetch the next result from the in-progress query into _result_prefix and return
+        # it, or return _missing if there are no more results.
+        if self._result_iterator is None:
+            return _missing
+        try:
+            result = next(self._result_iterator)
+        except StopIteration:
+            self._results = self._result_prefix
+            self._result_iterator = None
+            self.set_cached_results(self._results)
+            return _missing
+        self._result_prefix.append(result)
+        return result
+
+    def _fetch_all(self):
+        if self._results is None:
+            for result in self:
+                pass
+
+    def _fetch_to(self, count):
+        # ensure that the first `count` results (or all of them, if fewer) are available
+        # in _result_prefix or _results, without running the full query
+        if self._results is None and self._result_iterator is None:
+            for result in self:
+                break
+        if self._results is not None:
+            return self._results
+        while len(self._result_prefix) < count and self._consume_result() is not _missing:
+            pass
+        return self._result_prefix
+
+    def get_result_cache_key(self):
+        # querysets of different classes or models may share a result cache, so the
+        # query_key alone does not identify the results
+        cls = self.__class__
+        return (cls.__module__, cls.__qualname__, self.model, self.query_key)
+
+    def get_cached_entry(self):
+        # the value stored in the result cache for this query: a list of results, or a
+        # list of rows if result_cache_as_rows is set
+        if self.result_cache is None or self.refresh_cache:
+            return None
+        return self.result_cache.get(self.get_result_cache_key())
+
+    def get_cached_results(self):
+        results = self.get_cached_entry()
+        if results is not None and self.result_cache_as_rows:
+            results = self.rows_to_results(results)
+        return results
+
+    def set_cached_results(self, results):
+        if self.result_cache is None:
+            return
+        if self.result_cache_as_rows:
+            results = self.results_to_rows(results)
+        # query_key[0] is the normalised filter list, used for invalidating by filter
+        self.result_cache.set(self.get_result_cache_key(), results, filters=self.query_key[0])
+
+    def results_to_rows(self, results):
+        # convert a list of results into a compact form for the result cache
+        if isinstance(results, LazyRowList):
+            return results.rows
+        model = self.model
+        if model is None:
+            return list(results)
+        return [result.to_row() for result in results]
+
+    def rows_to_results(self, rows):
+        # model instances are only built from the rows as they are accessed
+        model = self.model
+        if model is None:
+            return list(rows)
+        return LazyRowList(rows, model.from_row)
+
+    def get_query_state(self):
+        # the query state of this queryset as plain Python values
+        return {
+            "filters": [list(item) for item in self.filters],
+            "ordering": list(self.ordering),
+            "offset": self.offset,
+            "limit": self.limit,
+            "only_fields": None if self.only_fields is None else list(self.only_fields),
+            "deferred_fields": list(self.deferred_fields),
+        }
+
+    def serialize(self):
+        """
+        Evaluate this queryset, and return its query state and results as a dict of plain
+        Python values that can be stored in an external cache and later restored with
+        deserialize(). Model instances are stored as tuples of their field values.
+        """
+        self._fetch_all()
+        return {
+            "query": self.get_query_state(),
+            "fields": None if self.model is None else list(self.model._meta.fields),
+            "rows": self.results_to_rows(self._results),
+        }
+
+    def deserialize(self, data):
+        """
+        Return a copy of this queryset with the query state and results recorded by
+        serialize(). Model instances are rebuilt as they are accessed.
+        """
+        fields = None if self.model is None else list(self.model._meta.fields)
+        if data["fields"] != fields:
+            raise ValueError("Serialized results do not match the fields of %r" % self.model)
+
+        query = data["query"]
+        filters = FilterChain()
+        for key, val in query["filters"]:
+            filters = filters.add(key, val)
+        only_fields = query["only_fields"]
+        clone = self.clone(
+            filters=filters,
+            ordering=tuple(query["ordering"]),
+            offset=query["offset"],
+            limit=query["limit"],
+            only_fields=None if only_fields is None else tuple(only_fields),
+            deferred_fields=tuple(query["deferred_fields"]),
+        )
+        clone._results = self.rows_to_results(data["rows"])
+        return clone
+
+    def __copy__(self):
+        # clone() relies on a plain shallow copy, sharing any caches held by the queryset
+        clone = self.__class__.__new__(self.__class__)
+        clone.__dict__.update(self.__dict__)
+        return clone
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        # partially-consumed results are discarded, as the iterator cannot be pickled
+        state["_result_iterator"] = None
+        state["_result_prefix"] = None
+        if isinstance(self._results, (SpillingResultList, ResultListView)):
+            state["_results"] = list(self._results)
+        return state
+
+    def __reduce_ex__(self, protocol):
+        model = self.model
+        if model is not None and type(self) is getattr(model, "query_class", None):
+            # the queryset class is generated by the model, so must be looked up through it
+            return (_new_model_queryset, (model,), self.__getstate__())
+        return super().__reduce_ex__(protocol)
+
+    def refresh(self, count=False):
+        """
+        Re-run the query for this queryset (or if `count` is true, its count), bypassing any
+        cached data and storing the fresh data in the caches. Returns the evaluated copy of
+        the queryset.
+        """
+        clone = self.clone(refresh_cache=True)
+        if count:
+            clone.count()
         else:
-            yield from self._results
+            clone._fetch_all()
+        clone.refresh_cache = False
+        return clone
+
+    def invalidate_result_cache(self, **filters):
+        """
+        Remove cached results for any query that includes all of the given filters, or
+        all cached results if no filters are given.
+        """
+        if self.result_cache is not None:
+            self.result_cache.invalidate((key, make_hashable(val)) for key, val in filters.items())
 
     def count(self):
         if self._count is None:
-            if self._results is not None:
-                self._count = len(self._results)
+            results = self._results
+            if results is None:
+                # count cached rows directly, without building results from them
+                results = self.get_cached_entry()
+            if results is not None:
+                self._count = len(results)
             else:
                 self._count = self.run_count()
         return self._count
 
     def __len__(self):
         # __len__ must run the full query
-        if self._results is None:
-            self._results = list(self.run_query())
+        self._fetch_all()
         return len(self._results)
 
     def clone(self, **kwargs):
         clone = copy.copy(self)
         clone._results = None
+        clone._result_iterator = None
+        clone._result_prefix = None
         clone._count = None
-        clone.filters = self.filters.copy()
         for key, value in kwargs.items():
             setattr(clone, key, value)
         return clone
@@ -67,13 +537,13 @@ class Queryish:
         return True
 
     def filter(self, **kwargs):
-        clone = self.clone()
+        filters = self.filters
         for key, val in kwargs.items():
             if self.filter_is_valid(key, val):
-                clone.filters.append((key, val))
+                filters = filters.add(key, val)
             else:
                 raise ValueError("Invalid filter field: %s" % key)
-        return clone
+        return self.clone(filters=filters)
 
     def ordering_is_valid(self, key):
         if self.ordering_fields is not None and key not in self.ordering_fields:
@@ -89,6 +559,63 @@ class Queryish:
                 raise ValueError("Invalid ordering field: %s" % key)
         return self.clone(ordering=tuple(ordering))
 
+    def only(self, *fields):
+        return self.clone(only_fields=tuple(fields), deferred_fields=())
+
+    def defer(self, *fields):
+        if fields == (None,):
+            # defer(None) clears any deferred fields, as per Django
+            return self.clone(deferred_fields=())
+        if self.only_fields is not None:
+            only_fields = tuple(field for field in self.only_fields if field not in fields)
+            return self.clone(only_fields=only_fields)
+        deferred_fields = self.deferred_fields + tuple(
+            field for field in fields if field not in self.deferred_fields
+        )
+        return self.clone(deferred_fields=deferred_fields)
+
+    def prefetch_related(self, *lookups):
+        if lookups == (None,):
+            return self.clone(prefetch_related_lookups=())
+        relations = self.model._meta.relations if self.model else {}
+        for lookup in lookups:
+            if lookup not in relations:
+                raise ValueError("Invalid prefetch_related lookup: %s" % lookup)
+        return self.clone(prefetch_related_lookups=self.prefetch_related_lookups + lookups)
+
+    def iter_with_prefetched_objects(self, results):
+        # consume results in batches, resolving the related objects for each batch at once
+        batch = []
+        for result in results:
+            batch.append(result)
+            if len(batch) >= self.prefetch_batch_size:
+                self.prefetch_related_objects(batch)
+                yield from batch
+                batch = []
+        if batch:
+            self.prefetch_related_objects(batch)
+            yield from batch
+
+    def prefetch_related_objects(self, instances):
+        for lookup in self.prefetch_related_lookups:
+            relation = self.model._meta.relations[lookup]
+            # collect the distinct related ids, in order of first appearance
+            related_ids = list(dict.fromkeys(
+                related_id for related_id in (
+                    getattr(instance, relation.field, None) for instance in instances
+                )
+                if related_id is not None
+            ))
+
+            related_objects = relation.related_model.objects.in_bulk(related_ids)
+            for instance in instances:
+                related_id = getattr(instance, relation.field, None)
+                # write to __dict__ to bypass the RelatedObjectDescriptor
+                instance.__dict__[lookup] = related_objects.get(related_id)
+
+    def union(self, *other_qs):
+        return UnionQuerySet([self, *other_qs])
+
     def get(self, **kwargs):
         results = list(self.filter(**kwargs)[:2])
         if len(results) == 0:
@@ -105,9 +632,63 @@ class Queryish:
         except IndexError:
             return None
 
+    def last(self):
+        if self._results is not None:
+            return self._results[-1] if len(self._results) else None
+
+        if self.ordered and self.supports_descending_ordering and self.offset == 0 and self.limit is None:
+            # fetch the first result of the reversed ordering
+            return self.reverse().first()
+
+        count = self.count()
+        if count == 0:
+            return None
+        results = list(self[count - 1:count])
+        try:
+            return results[0]
+        except IndexError:
+            return None
+
+    def reverse(self):
+        if self.offset or self.limit is not None:
+            raise TypeError("Cannot reverse a query once a slice has been taken.")
+        ordering = tuple(
+            field[1:] if field.startswith("-") else "-" + field
+            for field in self.ordering
+        )
+        return self.clone(ordering=ordering)
+
     def all(self):
         return self
 
+    def get_query_key(self):
+        """
+        Return a hashable representation of the query state, such that two querysets
+        of the same class with equal query keys will return the same results.
+        """
+        if isinstance(self.filters, FilterChain):
+            filters = self.filters.items
+        else:
+            filters = tuple((key, make_hashable(val)) for key, val in self.filters)
+        return (
+            filters, self.ordering, self.offset, self.limit,
+            self.only_fields, self.deferred_fields, self.prefetch_related_lookups,
+        )
+
+    @property
+    def query_key(self):
+        return self.get_query_key()
+
+    @property
+    def fingerprint(self):
+        """
+        A stable hex digest of the queryset class and query state, suitable for use
+        as an external cache key.
+        """
+        cls = self.__class__
+        key = (cls.__module__, cls.__qualname__, self.get_query_key())
+        return hashlib.sha1(get_canonical_form(key).encode("utf-8")).hexdigest()
+
     @property
     def ordered(self):
         return bool(self.ordering)
@@ -117,6 +698,17 @@ class Queryish:
             if key.step is not None:
                 raise ValueError("%r does not support slicing with a step" % self.__class__.__name__)
 
+            if (key.start or 0) < 0 or (key.stop or 0) < 0:
+                # convert negative indices to positive ones using the (cheaper) count
+                # rather than fetching the full result set
+                count = self.count()
+                start, stop = key.start, key.stop
+                if start is not None and start < 0:
+                    start = max(0, count + start)
+                if stop is not None and stop < 0:
+                    stop = max(0, count + stop)
+                key = slice(start, stop)
+
             # Adjust the requested start/stop values to be relative to the full queryset
             absolute_start = (key.start or 0) + self.offset
             if key.stop is None:
@@ -140,18 +732,32 @@ class Queryish:
             if final_absolute_stop is None:
                 new_limit = None
             else:
-                new_limit = final_absolute_stop - absolute_start
+                new_limit = max(0, final_absolute_stop - absolute_start)
 
             clone = self.clone(offset=absolute_start, limit=new_limit)
             if self._results:
                 clone._results = self._results[key]
+            elif (
+                self._result_iterator is not None
+                and key.stop is not None
+                and len(self._result_prefix) >= key.stop
+            ):
+                # the slice falls within the results consumed so far
+                clone._results = self._result_prefix[key]
             return clone
         elif isinstance(key, int):
             if key < 0:
-                raise IndexError("Negative indexing is not supported")
-            if self._results is None:
-                self._results = list(self.run_query())
-            return self._results[key]
+                if self._results is not None:
+                    return self._results[key]
+                # find the position from the end using count(), and fetch just that item
+                index = self.count() + key
+                if index < 0:
+                    raise IndexError("%s index out of range" % self.__class__.__name__)
+                results = list(self[index:index + 1])
+                if not results:
+                    raise IndexError("%s index out of range" % self.__class__.__name__)
+                return results[0]
+            return self._fetch_to(key + 1)[key]
         else:
             raise TypeError(
                 "%r indices must be integers or slices, not %s"
@@ -165,12 +771,307 @@ class Queryish:
         return "<%s %r>" % (self.__class__.__name__, items)
 
 
+class Field:
+    """
+    A declaration of a model field, for use in the `fields` list of a VirtualModel's Meta
+    class in place of a plain field name. `source` is the key (or dotted path of keys) to
+    read from the record data, defaulting to the field name; `converter` is a function
+    applied to any non-null value found there, and `default` is the value used when the
+    key is missing.
+    """
+
+    def __init__(self, name, source=None, converter=None, default=None):
+        self.name = name
+        self.source = source or name
+        self.converter = converter
+        self.default = default
+
+    @property
+    def source_path(self):
+        return self.source.split(".")
+
+    @property
+    def is_plain(self):
+        return self.source == self.name and self.converter is None and self.default is None
+
+    def get_value(self, data):
+        value = data
+        for key in self.source_path:
+            if not isinstance(value, dict) or key not in value:
+                return self.default
+            value = value[key]
+        if value is not None and self.converter is not None:
+            value = self.converter(value)
+        return value
+
+    def __repr__(self):
+        return "<Field: %s>" % self.name
+
+
+class Relation:
+    """
+    A declaration of a related model, for use in the `relations` dict of a VirtualModel's
+    Meta class. `field` is the name of the field holding the related object's primary key,
+    and `model` is the related model class, or a function returning it (to allow referring
+    to models that are defined later).
+    """
+
+    def __init__(self, field, model):
+        self.field = field
+        self.model = model
+
+    @property
+    def related_model(self):
+        if isinstance(self.model, type):
+            return self.model
+        return self.model()
+
+
+class RelatedObjectDescriptor:
+    """
+    Provides access to a related object, fetched on first access unless it has already
+    been populated by prefetch_related.
+    """
+
+    def __init__(self, name, relation):
+        self.name = name
+        self.relation = relation
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        related_id = getattr(instance, self.relation.field, None)
+        if related_id is None:
+            related_object = None
+        else:
+            related_object = self.relation.related_model.objects.get(pk=related_id)
+        instance.__dict__[self.name] = related_object
+        return related_object
+
+
+def compile_constructor(model, field_specs):
+    """
+    Generate a function that builds an instance of `model` from a record of query data
+    according to `field_specs`. Where the model uses the standard VirtualModel.__init__,
+    the generated function populates the instance's attributes directly; otherwise it
+    passes the field values to the model's constructor as keyword arguments.
+    """
+    init = model.__init__
+    construct_directly = (
+        getattr(init, "__qualname__", None) == "VirtualModel.__init__"
+        and init.__module__ == __name__
+    )
+    if not construct_directly and all(spec.is_plain for spec in field_specs):
+        # retain the original behaviour of passing the full record to the constructor
+        return lambda data: model(**data)
+
+    namespace = {"model": model, "_missing": _missing, "new": model.__new__}
+    lines = ["    get = data.get"]
+    values = []
+    for i, spec in enumerate(field_specs):
+        path = spec.source_path
+        if len(path) == 1 and spec.converter is None and spec.default is None:
+            # simple lookup, which can be inlined
+            values.append((spec.name, "get(%r)" % path[0]))
+            continue
+
+        var = "v%d" % i
+        lines.append("    %s = get(%r, _missing)" % (var, path[0]))
+        for key in path[1:]:
+            lines.append(
+                "    %s = %s.get(%r, _missing) if isinstance(%s, dict) else _missing"
+                % (var, var, key, var)
+            )
+        namespace["default%d" % i] = spec.default
+        lines.append("    if %s is _missing:" % var)
+        lines.append("        %s = default%d" % (var, i))
+        if spec.converter is not None:
+            namespace["converter%d" % i] = spec.converter
+            lines.append("    elif %s is not None:" % var)
+            lines.append("        %s = converter%d(%s)" % (var, i, var))
+        values.append((spec.name, var))
+
+    field_names = [name for name, var in values]
+    if model.pk_field_name in field_names:
+        pk_expr = values[field_names.index(model.pk_field_name)][1]
+    else:
+        pk_expr = "get(%r)" % model.pk_field_name
+
+    if construct_directly:
+        lines.append("    obj = new(model)")
+        items = ["%r: %s" % (name, var) for name, var in values]
+        items.append("'pk': %s" % pk_expr)
+        lines.append("    obj.__dict__.update({%s})" % ", ".join(items))
+        lines.append("    return obj")
+    else:
+        kwargs = ["%r: %s" % (name, var) for name, var in values]
+        if model.pk_field_name not in field_names:
+            kwargs.append("%r: %s" % (model.pk_field_name, pk_expr))
+        lines.append("    return model(**{%s})" % ", ".join(kwargs))
+
+    source = "def construct(data):\n" + "\n".join(lines) + "\n"
+    exec(compile(source, "<%s constructor>" % model.__name__, "exec"), namespace)
+    return namespace["construct"]
+
+
+def _new_model_queryset(model):
+    return model.query_class.__new__(model.query_class)
+
+
+class SortKey:
+    """
+    A sort key for a record, comparing the values of the given fields in turn, with
+    descending order for fields prefixed with '-'. Nulls come after all other values, or
+    before them in descending order.
+    """
+    __slots__ = ("values", "descending")
+
+    def __init__(self, values, descending):
+        # place nulls after all other values, rather than failing to compare them
+        self.values = [(value is None, value) for value in values]
+        self.descending = descending
+
+    def __lt__(self, other):
+        for a, b, descending in zip(self.values, other.values, self.descending):
+            if a == b:
+                continue
+            return a > b if descending else a < b
+        return False
+
+    def __eq__(self, other):
+        return self.values == other.values
+
+
+def get_sort_key_function(ordering, get_value):
+    """
+    Return a function that gives the SortKey of a record for the given ordering, reading
+    each field's value with get_value(record, field)
+    """
+    fields = [field.lstrip("-") for field in ordering]
+    descending = [field.startswith("-") for field in ordering]
+
+    def get_sort_key(record):
+        return SortKey([get_value(record, field) for field in fields], descending)
+
+    return get_sort_key
+
+
+class UnionQuerySet(Queryish):
+    """
+    A queryset combining the results of several querysets. Filters, ordering and slicing
+    are passed on to each of the child querysets, which are fetched concurrently; ordered
+    results are merged as they are consumed, so that only as many results as are needed
+    for the final slice are fetched from each child.
+    """
+
+    def __init__(self, querysets):
+        super().__init__()
+        self.querysets = tuple(querysets)
+        if self.querysets:
+            self.model = self.querysets[0].model
+
+    def get_query_key(self):
+        children = tuple(
+            (qs.__class__.__module__, qs.__class__.__qualname__, qs.get_query_key())
+            for qs in self.querysets
+        )
+        return super().get_query_key() + (children,)
+
+    def get_child_querysets(self, sliced=True):
+        children = []
+        for qs in self.querysets:
+            for key, val in self.filters:
+                qs = qs.filter(**{key: val})
+            if self.ordering:
+                qs = qs.order_by(*self.ordering)
+            if sliced and self.limit is not None:
+                # each child must return enough results to fill the slice on its own
+                qs = qs[:self.offset + self.limit]
+            children.append(qs)
+        return children
+
+    def run_query(self):
+        children = self.get_child_querysets()
+        # fetch the first results of each child concurrently; the remainder are
+        # fetched as needed while merging
+        gather(*[(lambda child=child: child._fetch_to(1)) for child in children])
+
+        if self.ordering:
+            results = heapq.merge(
+                *children, key=get_sort_key_function(self.ordering, self.get_record_value)
+            )
+        else:
+            results = itertools.chain(*children)
+
+        if self.limit is None:
+            stop = None
+        else:
+            stop = self.offset + self.limit
+        return itertools.islice(results, self.offset, stop)
+
+    def run_count(self):
+        counts = gather(*[child.count for child in self.get_child_querysets(sliced=False)])
+        count = max(0, sum(counts) - self.offset)
+        if self.limit is not None:
+            count = min(count, self.limit)
+        return count
+
+
+GATHER_MAX_WORKERS = 8
+
+
+def _evaluate(item):
+    if isinstance(item, Queryish):
+        item._fetch_all()
+        return item
+    return item()
+
+
+def gather(*items, executor=None):
+    """
+    Evaluate several querysets or pending queryset operations concurrently, returning
+    a list of their results. Each item may be a queryset, which is fully evaluated
+    (so that subsequent iteration over it is served from its result cache) and returned
+    as the result; or a callable such as `qs.count` or `qs.first`, whose return value is
+    the result. Items are evaluated on a thread pool of up to GATHER_MAX_WORKERS threads
+    created for the call, unless an alternative executor is passed, within a copy of the
+    caller's context (so that an active `cache_scope` applies to them).
+    """
+    if executor is not None:
+        futures = [
+            executor.submit(contextvars.copy_context().run, _evaluate, item)
+            for item in items
+        ]
+        return [future.result() for future in futures]
+
+    if len(items) <= 1:
+        return [_evaluate(item) for item in items]
+    # use a dedicated executor, so that gather() calls made by the items themselves
+    # cannot wait on threads that are occupied by their callers
+    with ThreadPoolExecutor(
+        max_workers=min(len(items), GATHER_MAX_WORKERS), thread_name_prefix="queryish-gather"
+    ) as executor:
+        return gather(*items, executor=executor)
+
+
 class VirtualModelOptions:
     def __init__(self, model_name, fields, verbose_name, verbose_name_plural):
         self.model_name = model_name
-        self.fields = fields
+        self.field_specs = [
+            field if isinstance(field, Field) else Field(field)
+            for field in fields
+        ]
+        self.fields = [field.name for field in self.field_specs]
         self.verbose_name = verbose_name
         self.verbose_name_plural = verbose_name_plural
+        self.relations = {}
+        self.constructor = None
+
+    def get_field(self, name):
+        for field in self.field_specs:
+            if field.name == name:
+                return field
+        return None
 
 
 class VirtualModelMetaclass(type):
@@ -183,6 +1084,7 @@ class VirtualModelMetaclass(type):
             # and any additional attributes defined on the Meta class
             dct = {
                 "model": model,
+                "__module__": model.__module__,
             }
             if meta:
                 for attr in dir(meta):
@@ -208,27 +1110,76 @@ class VirtualModelMetaclass(type):
             verbose_name=verbose_name,
             verbose_name_plural=getattr(meta, "verbose_name_plural", verbose_name + "s"),
         )
+        model._meta.constructor = compile_constructor(model, model._meta.field_specs)
+
+        for relation_name, relation in getattr(meta, "relations", {}).items():
+            if not isinstance(relation, Relation):
+                relation = Relation(*relation)
+            model._meta.relations[relation_name] = relation
+            setattr(model, relation_name, RelatedObjectDescriptor(relation_name, relation))
 
         return model
 
 
+def _model_from_row(model, row):
+    return model.from_row(row)
+
+
 class VirtualModel(metaclass=VirtualModelMetaclass):
     base_query_class = None
     pk_field_name = "id"
 
     @classmethod
     def from_query_data(cls, data):
-        return cls(**data)
+        return cls._meta.constructor(data)
+
+    @classmethod
+    def from_query_data_many(cls, rows):
+        if cls.from_query_data.__func__ is not VirtualModel.from_query_data.__func__:
+            # from_query_data has been overridden, so we must call it for each row
+            return [cls.from_query_data(row) for row in rows]
+        construct = cls._meta.constructor
+        return [construct(row) for row in rows]
 
     @classmethod
     def from_individual_data(cls, data):
         return cls.from_query_data(data)
 
+    @classmethod
+    def from_row(cls, row):
+        """
+        Rebuild an instance from a tuple of field values as returned by to_row, without
+        applying field conversions again.
+        """
+        if cls.__init__ is not VirtualModel.__init__:
+            return cls(**dict(zip(cls._meta.fields, row)))
+        obj = cls.__new__(cls)
+        obj.__dict__.update(zip(cls._meta.fields, row))
+        obj.pk = obj.__dict__.get(cls.pk_field_name)
+        return obj
+
     def __init__(self, **kwargs):
         for field in self._meta.fields:
             setattr(self, field, kwargs.get(field))
         self.pk = kwargs.get(self.pk_field_name)
 
+    def to_row(self):
+        """Return the values of this instance's fields as a tuple, ordered as _meta.fields"""
+        return tuple(getattr(self, field, None) for field in self._meta.fields)
+
+    def __reduce__(self):
+        # Pickle instances as a row of field values where this loses nothing, i.e. the
+        # instance has no attributes beyond its fields and a pk that can be derived from them
+        fields = self._meta.fields
+        state = self.__dict__
+        if (
+            type(self).__init__ is VirtualModel.__init__
+            and state.get("pk") == state.get(self.pk_field_name)
+            and all(key in fields or key == "pk" for key in state)
+        ):
+            return (_model_from_row, (type(self), self.to_row()))
+        return super().__reduce__()
+
     def __str__(self):
         return f"{self.__class__.__name__} object ({self.pk})"
 
@@ -0,0 +1,124 @@
+class Aggregate:
+    """
+    Base class for aggregate functions that can be passed to `Queryish.aggregate`.
+    Aggregates are computed in a single pass over the records, by creating an
+    accumulator object for each aggregate and passing each value to its `add` method.
+    """
+    name = None
+
+    def __init__(self, field):
+        self.field = field
+
+    @property
+    def default_alias(self):
+        return "%s__%s" % (self.field, self.name.lower())
+
+    def get_accumulator(self):
+        raise NotImplementedError
+
+    def __repr__(self):
+        return "%s(%r)" % (self.__class__.__name__, self.field)
+
+
+class CountAccumulator:
+    def __init__(self, distinct=False):
+        self.value = 0
+        self.seen = set() if distinct else None
+
+    def add(self, value):
+        if value is None:
+            return
+        if self.seen is not None:
+            if value in self.seen:
+                return
+            self.seen.add(value)
+        self.value += 1
+
+    def result(self):
+        return self.value
+
+
+class Count(Aggregate):
+    name = "Count"
+
+    def __init__(self, field="*", distinct=False):
+        super().__init__(field)
+        self.distinct = distinct
+
+    @property
+    def counts_rows(self):
+        # Count("*") counts every record, and so can be answered by Queryish.count()
+        return self.field == "*" and not self.distinct
+
+    def get_accumulator(self):
+        return CountAccumulator(distinct=self.distinct)
+
+
+class SumAccumulator:
+    def __init__(self):
+        self.value = None
+
+    def add(self, value):
+        if value is None:
+            return
+        self.value = value if self.value is None else self.value + value
+
+    def result(self):
+        return self.value
+
+
+class Sum(Aggregate):
+    name = "Sum"
+
+    def get_accumulator(self):
+        return SumAccumulator()
+
+
+class MinAccumulator(SumAccumulator):
+    def add(self, value):
+        if value is not None and (self.value is None or value < self.value):
+            self.value = value
+
+
+class Min(Aggregate):
+    name = "Min"
+
+    def get_accumulator(self):
+        return MinAccumulator()
+
+
+class MaxAccumulator(SumAccumulator):
+    def add(self, value):
+        if value is not None and (self.value is None or value > self.value):
+            self.value = value
+
+
+class Max(Aggregate):
+    name = "Max"
+
+    def get_accumulator(self):
+        return MaxAccumulator()
+
+
+class AvgAccumulator:
+    def __init__(self):
+        self.total = 0
+        self.count = 0
+
+    def add(self, value):
+        if value is None:
+            return
+        self.total += value
+        self.count += 1
+
+    def result(self):
+        if self.count == 0:
+            return None
+        return self.total / self.count
+
+
+class Avg(Aggregate):
+    name = "Avg"
+
+    def get_accumulator(self):
+        return AvgAccumulator()
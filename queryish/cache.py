@@ -0,0 +1,167 @@
+from collections import OrderedDict
+from contextlib import contextmanager
+import contextvars
+import threading
+import time
+
+
+class ResultCache:
+    """
+    A bounded, time-limited cache of evaluated query results, shared between all
+    querysets of a given class (typically by defining `result_cache` on a model's Meta
+    class). Entries are keyed by the queryset's class, model and `query_key`, and the
+    oldest entries are discarded once `max_size` is reached.
+    """
+
+    def __init__(self, timeout=None, max_size=None):
+        self.timeout = timeout
+        self.max_size = max_size
+        self._entries = OrderedDict()  # key -> (expiry time, filters, value)
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                expiry, filters, value = self._entries[key]
+            except KeyError:
+                return default
+            if expiry is not None and expiry <= time.monotonic():
+                del self._entries[key]
+                return default
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, filters=()):
+        if self.timeout is None:
+            expiry = None
+        else:
+            expiry = time.monotonic() + self.timeout
+
+        with self._lock:
+            self._entries[key] = (expiry, frozenset(filters), value)
+            self._entries.move_to_end(key)
+            if self.max_size is not None:
+                while len(self._entries) > self.max_size:
+                    self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def invalidate(self, filters=()):
+        """
+        Remove all entries whose filters include every one of the given (key, value)
+        pairs, or all entries if no filters are given.
+        """
+        filters = frozenset(filters)
+        with self._lock:
+            if not filters:
+                self._entries.clear()
+                return
+            for key in [
+                key for key, (expiry, entry_filters, value) in self._entries.items()
+                if filters <= entry_filters
+            ]:
+                del self._entries[key]
+
+    def clear(self):
+        self.invalidate()
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class IdentityMap(ResultCache):
+    """
+    A bounded, time-limited map of primary keys to the instances retrieved for them,
+    recording whether each instance was built from a listing record or a (potentially
+    more complete) detail record.
+    """
+
+    def add(self, pk, instance, detail=False):
+        if not detail:
+            # do not replace an instance from a detail record with a listing one
+            entry = self.get(pk)
+            if entry is not None and entry[1]:
+                return
+        self.set(pk, (instance, detail))
+
+    def lookup(self, pk, detail=False):
+        """
+        Return the instance for the given primary key, or None if it is not known.
+        If `detail` is true, only instances built from detail records are returned.
+        """
+        entry = self.get(pk)
+        if entry is None or (detail and not entry[1]):
+            return None
+        return entry[0]
+
+
+class CacheScope:
+    """
+    A cache of API responses and identity maps that is shared by all querysets evaluated
+    while it is active, and discarded when it ends. Created by `cache_scope`.
+    """
+
+    def __init__(self):
+        self.responses = {}
+        self.record_sets = {}
+        self.identity_maps = {}
+        self.readahead_futures = set()
+        self.closed = False
+        self._lock = threading.Lock()
+
+    def get_identity_map(self, key):
+        with self._lock:
+            try:
+                return self.identity_maps[key]
+            except KeyError:
+                identity_map = self.identity_maps[key] = IdentityMap()
+                return identity_map
+
+    def add_readahead_future(self, future):
+        """
+        Register a Future for a response being read ahead into this scope, so that it can
+        be cancelled when the scope is cleared
+        """
+        with self._lock:
+            self.readahead_futures.add(future)
+        future.add_done_callback(self.readahead_futures.discard)
+
+    def clear(self):
+        with self._lock:
+            # readahead that has not yet started would only fill the cleared caches
+            for future in list(self.readahead_futures):
+                future.cancel()
+            self.readahead_futures.clear()
+            self.responses.clear()
+            self.record_sets.clear()
+            self.identity_maps.clear()
+
+
+_current_scope = contextvars.ContextVar("queryish_cache_scope", default=None)
+
+
+def get_current_scope():
+    """Return the active CacheScope, or None if there is none"""
+    return _current_scope.get()
+
+
+@contextmanager
+def cache_scope():
+    """
+    Context manager that activates a new CacheScope for the duration of the block, such as
+    a web request or background job. Identical API requests made within the block are
+    only made once, and the cached responses are released when the block exits.
+    """
+    scope = CacheScope()
+    token = _current_scope.set(scope)
+    try:
+        yield scope
+    finally:
+        _current_scope.reset(token)
+        scope.closed = True
+        scope.clear()
@@ -0,0 +1,325 @@
+from functools import cached_property
+
+import numpy as np
+
+from queryish import Queryish
+from queryish.memory import LOOKUPS, SearchIndex, _as_list, get_search_scores, split_lookup
+
+
+class Column:
+    """
+    A column of values held in a NumPy array, along with a boolean array marking null
+    (None) values, or None if the column has no nulls.
+    """
+
+    def __init__(self, values, nulls=None):
+        self.values = values
+        self.nulls = nulls
+
+    def __len__(self):
+        return len(self.values)
+
+    def get(self, index):
+        if self.nulls is not None and self.nulls[index]:
+            return None
+        return self.values[index].item()
+
+    def get_null_mask(self):
+        if self.nulls is None:
+            return np.zeros(len(self), dtype=bool)
+        return self.nulls
+
+    def mask(self, lookup, arg):
+        """Return a boolean array of the rows that match the given lookup"""
+        if lookup == "isnull":
+            return self.get_null_mask() == bool(arg)
+        if lookup == "exact" and arg is None:
+            return self.get_null_mask().copy()
+        return self.match_values(lookup, arg) & ~self.get_null_mask()
+
+    def match_values(self, lookup, arg):
+        # evaluate the lookup against each value with the equivalent Python test
+        test = LOOKUPS[lookup]
+        return np.fromiter(
+            (test(self.get(index), arg) for index in range(len(self))),
+            dtype=bool, count=len(self),
+        )
+
+    def get_sort_keys(self):
+        """
+        Return an integer array that orders rows with equal values together. Nulls are
+        given an arbitrary key, and must be ordered separately with get_null_mask.
+        """
+        raise NotImplementedError
+
+
+class NumericColumn(Column):
+    COMPARISONS = {
+        "exact": np.equal,
+        "gt": np.greater,
+        "gte": np.greater_equal,
+        "lt": np.less,
+        "lte": np.less_equal,
+    }
+
+    def match_values(self, lookup, arg):
+        if lookup in self.COMPARISONS and isinstance(arg, (int, float)):
+            return self.COMPARISONS[lookup](self.values, arg)
+        if lookup == "in":
+            args = [item for item in _as_list(arg) if isinstance(item, (int, float))]
+            return np.isin(self.values, args)
+        return super().match_values(lookup, arg)
+
+    def get_sort_keys(self):
+        return self.values
+
+
+class BooleanColumn(NumericColumn):
+    def get_sort_keys(self):
+        return self.values.astype(np.int8)
+
+
+class StringColumn(Column):
+    """
+    A dictionary-encoded column of strings. `categories` is the sorted list of distinct
+    values, and `values` holds the index of each row's value within it, or -1 for None.
+    """
+
+    def __init__(self, categories, values):
+        nulls = values == -1
+        super().__init__(values, nulls if nulls.any() else None)
+        self.categories = categories
+
+    def get(self, index):
+        code = self.values[index]
+        if code == -1:
+            return None
+        return self.categories[code]
+
+    def match_values(self, lookup, arg):
+        # evaluate the lookup once for each distinct value
+        test = LOOKUPS[lookup]
+        matches = [code for code, value in enumerate(self.categories) if test(value, arg)]
+        return np.isin(self.values, matches)
+
+    def get_sort_keys(self):
+        # categories are sorted, so the codes order the same way as the strings
+        return self.values
+
+
+class ObjectColumn(Column):
+    def get(self, index):
+        return self.values[index]
+
+    def get_sort_keys(self):
+        # rank the values, giving equal values the same rank
+        keys = np.zeros(len(self), dtype=np.int64)
+        indexes = [index for index in range(len(self)) if self.values[index] is not None]
+        indexes.sort(key=lambda index: self.values[index])
+        rank = 0
+        for i, index in enumerate(indexes):
+            if i and self.values[indexes[i - 1]] != self.values[index]:
+                rank += 1
+            keys[index] = rank
+        return keys
+
+
+def build_column(values):
+    """Choose the most compact representation for a list of values"""
+    non_null = [value for value in values if value is not None]
+    types = {type(value) for value in non_null}
+    nulls = np.array([value is None for value in values], dtype=bool)
+    has_nulls = len(non_null) < len(values)
+
+    if types == {str}:
+        categories = sorted(set(non_null))
+        codes = {value: code for code, value in enumerate(categories)}
+        return StringColumn(categories, np.array(
+            [-1 if value is None else codes[value] for value in values], dtype=np.int32
+        ))
+
+    if types and types <= {int, float, bool}:
+        if types == {bool}:
+            dtype = bool
+        elif float in types:
+            dtype = np.float64
+        else:
+            dtype = np.int64
+        fill = dtype(0)
+        try:
+            array = np.array([fill if value is None else value for value in values], dtype=dtype)
+        except OverflowError:
+            pass
+        else:
+            if dtype is bool:
+                # bools are compared and sorted as integers
+                return BooleanColumn(array, nulls if has_nulls else None)
+            return NumericColumn(array, nulls if has_nulls else None)
+
+    array = np.empty(len(values), dtype=object)
+    array[:] = values
+    return ObjectColumn(array, nulls if has_nulls else None)
+
+
+class ColumnStore:
+    """
+    An in-memory collection of records stored column-wise in NumPy arrays, supporting
+    filtering, ordering, slicing and counting with vectorised operations. Records are
+    dicts; keys that are missing from a record are treated as None. `search` lookups are
+    served from an inverted index for each field, built when the field is first searched.
+    """
+
+    def __init__(self, records, fields=None):
+        records = list(records)
+        if fields is None:
+            fields = {}
+            for record in records:
+                fields.update(dict.fromkeys(record))
+        self.fields = list(fields)
+        self.length = len(records)
+        self.columns = {
+            field: build_column([record.get(field) for record in records])
+            for field in self.fields
+        }
+        self._search_indexes = {}
+
+    def __len__(self):
+        return self.length
+
+    def get_row(self, index):
+        return {field: column.get(index) for field, column in self.columns.items()}
+
+    def get_search_index(self, field):
+        index = self._search_indexes.get(field)
+        if index is None:
+            index = SearchIndex()
+            column = self.columns[field]
+            for row in range(self.length):
+                index.add(row, column.get(row))
+            self._search_indexes[field] = index
+        return index
+
+    def filter(self, filters, scores=None):
+        """
+        Return a boolean array of the rows that match all of the given filters. `scores`
+        is the result of get_search_scores for the filters, if already known.
+        """
+        if scores is None:
+            scores = get_search_scores(filters, self.get_search_index)
+        if scores is None:
+            mask = np.ones(self.length, dtype=bool)
+        else:
+            mask = np.zeros(self.length, dtype=bool)
+            mask[np.fromiter(scores, dtype=np.int64, count=len(scores))] = True
+
+        for key, arg in filters:
+            field, lookup = split_lookup(key)
+            if lookup != "search":
+                mask &= self.columns[field].mask(lookup, arg)
+        return mask
+
+    def get_sort_keys(self, ordering):
+        # Return the keys to pass to np.lexsort, most significant last. As with RecordSet,
+        # nulls come after all other values, or before them in descending order
+        keys = []
+        for field in reversed(ordering):
+            column = self.columns[field.lstrip("-")]
+            values = column.get_sort_keys()
+            nulls = column.get_null_mask()
+            if field.startswith("-"):
+                keys.append(-values.astype(np.float64 if values.dtype.kind == "f" else np.int64))
+                keys.append(-nulls.astype(np.int8))
+            else:
+                keys.append(values)
+                keys.append(nulls)
+        return keys
+
+    def query(self, filters=(), ordering=(), offset=0, limit=None):
+        """Return an array of the indexes of the matching rows, ordered and sliced"""
+        scores = get_search_scores(filters, self.get_search_index)
+        indexes = np.flatnonzero(self.filter(filters, scores))
+        stop = None if limit is None else offset + limit
+
+        if not ordering and scores:
+            # order search results by relevance, and then by their original order
+            relevance = np.fromiter(
+                (scores[index] for index in indexes), dtype=np.int64, count=len(indexes)
+            )
+            indexes = indexes[np.lexsort([indexes, -relevance])]
+        elif ordering:
+            keys = [key[indexes] for key in self.get_sort_keys(ordering)]
+            primary_nulls, primary = keys[-1], keys[-2]
+            if stop is not None and 0 < stop < len(indexes) and not primary_nulls.any():
+                # only the first `stop` rows are needed: find the `stop`th smallest value of
+                # the primary key, and fully sort only the rows up to and including it
+                threshold = np.partition(primary, stop - 1)[stop - 1]
+                candidates = np.flatnonzero(primary <= threshold)
+                order = candidates[np.lexsort([key[candidates] for key in keys])]
+            else:
+                order = np.lexsort(keys)
+            indexes = indexes[order]
+
+        return indexes[offset:stop]
+
+    def count(self, filters=(), offset=0, limit=None):
+        count = max(0, int(self.filter(filters).sum()) - offset)
+        if limit is not None:
+            count = min(count, limit)
+        return count
+
+
+class ColumnarQuerySet(Queryish):
+    """
+    A queryset over an in-memory ColumnStore, given either as `column_store` or as a list
+    of dicts in `records`. Model instances are only built for the rows that are returned.
+    """
+    records = None
+    column_store = None
+    pk_field_name = "id"
+    supports_descending_ordering = True
+
+    def __init__(self):
+        super().__init__()
+        if self.column_store is None and self.records is not None:
+            self.column_store = ColumnStore(self.records)
+
+    @cached_property
+    def filter_field_aliases(self):
+        return {"pk": self.pk_field_name}
+
+    def get_column_lookup(self, key):
+        # map a filter key such as pk__in to the equivalent lookup on a column
+        field, lookup = split_lookup(key)
+        field = self.filter_field_aliases.get(field, field)
+        return "%s__%s" % (field, lookup)
+
+    def get_column_filters(self):
+        return [(self.get_column_lookup(key), val) for key, val in self.filters]
+
+    def filter_is_valid(self, key, val):
+        field = split_lookup(key)[0]
+        field = self.filter_field_aliases.get(field, field)
+        if field not in self.column_store.columns:
+            return False
+        return super().filter_is_valid(field, val)
+
+    def ordering_is_valid(self, key):
+        if key.lstrip("-") not in self.column_store.columns:
+            return False
+        return super().ordering_is_valid(key)
+
+    def get_instance(self, val):
+        if self.model:
+            return self.model.from_query_data(val)
+        else:
+            return val
+
+    def run_query(self):
+        indexes = self.column_store.query(
+            self.get_column_filters(), self.ordering, self.offset, self.limit
+        )
+        for index in indexes:
+            yield self.get_instance(self.column_store.get_row(index))
+
+    def run_count(self):
+        return self.column_store.count(self.get_column_filters(), self.offset, self.limit)
@@ -0,0 +1,241 @@
+import bisect
+import heapq
+import re
+
+from queryish import get_sort_key_function
+
+
+def _as_list(val):
+    if isinstance(val, str):
+        return val.split(",")
+    return list(val)
+
+
+def tokenize(text):
+    # split text into lowercase words for searching
+    if text is None:
+        return []
+    return re.findall(r"\w+", str(text).lower())
+
+
+def _search_matches(value, arg):
+    # every word of the query must be a prefix of a word in the value
+    words = tokenize(arg)
+    value_words = tokenize(value)
+    return bool(words) and all(
+        any(value_word.startswith(word) for value_word in value_words) for word in words
+    )
+
+
+LOOKUPS = {
+    "exact": lambda value, arg: value == arg,
+    "iexact": lambda value, arg: value is not None and str(value).lower() == str(arg).lower(),
+    "contains": lambda value, arg: value is not None and str(arg) in str(value),
+    "icontains": lambda value, arg: value is not None and str(arg).lower() in str(value).lower(),
+    "startswith": lambda value, arg: value is not None and str(value).startswith(str(arg)),
+    "istartswith": lambda value, arg: (
+        value is not None and str(value).lower().startswith(str(arg).lower())
+    ),
+    "in": lambda value, arg: value in _as_list(arg),
+    "gt": lambda value, arg: value is not None and value > arg,
+    "gte": lambda value, arg: value is not None and value >= arg,
+    "lt": lambda value, arg: value is not None and value < arg,
+    "lte": lambda value, arg: value is not None and value <= arg,
+    "isnull": lambda value, arg: (value is None) == bool(arg),
+    "search": _search_matches,
+}
+
+
+def split_lookup(key):
+    """
+    Split a filter key such as "name__icontains" into a field name and lookup type,
+    defaulting to an "exact" lookup.
+    """
+    field, sep, lookup = key.rpartition("__")
+    if sep and lookup in LOOKUPS:
+        return field, lookup
+    return key, "exact"
+
+
+def get_value(record, field):
+    if isinstance(record, dict):
+        return record.get(field)
+    return getattr(record, field, None)
+
+
+class SearchIndex:
+    """
+    An inverted index of the words in a text field, mapping each word to the keys of the
+    records containing it. Words are also held in a sorted list, so that the words
+    beginning with a given prefix can be found by binary search.
+    """
+
+    def __init__(self):
+        self.postings = {}
+        self.terms = []
+
+    def add(self, key, text):
+        for term in set(tokenize(text)):
+            keys = self.postings.get(term)
+            if keys is None:
+                keys = self.postings[term] = set()
+                bisect.insort(self.terms, term)
+            keys.add(key)
+
+    def remove(self, key, text):
+        for term in set(tokenize(text)):
+            keys = self.postings.get(term)
+            if keys is None:
+                continue
+            keys.discard(key)
+            if not keys:
+                del self.postings[term]
+                del self.terms[bisect.bisect_left(self.terms, term)]
+
+    def get_prefixed_terms(self, prefix):
+        start = bisect.bisect_left(self.terms, prefix)
+        end = bisect.bisect_left(self.terms, prefix + "\U0010ffff", start)
+        return self.terms[start:end]
+
+    def search(self, query):
+        """
+        Return a dict mapping the keys of the records that match every word of `query`
+        (as a prefix of one of their words) to a relevance score, which counts 2 for each
+        word matched exactly and 1 for each matched by prefix only.
+        """
+        scores = None
+        for word in set(tokenize(query)):
+            word_scores = {}
+            for term in self.get_prefixed_terms(word):
+                score = 2 if term == word else 1
+                for key in self.postings[term]:
+                    if word_scores.get(key, 0) < score:
+                        word_scores[key] = score
+            if scores is not None:
+                word_scores = {
+                    key: scores[key] + score for key, score in word_scores.items()
+                    if key in scores
+                }
+            scores = word_scores
+            if not scores:
+                break
+        return scores or {}
+
+
+def get_search_scores(filters, get_index):
+    """
+    Return a dict mapping record keys to relevance scores for the records that match all
+    of the `search` lookups in `filters`, using `get_index(field)` to obtain the SearchIndex
+    for each field; or None if there are no `search` lookups.
+    """
+    scores = None
+    for key, arg in filters:
+        field, lookup = split_lookup(key)
+        if lookup != "search":
+            continue
+        field_scores = get_index(field).search(arg)
+        if scores is not None:
+            field_scores = {
+                record_key: scores[record_key] + score
+                for record_key, score in field_scores.items() if record_key in scores
+            }
+        scores = field_scores
+    return scores
+
+
+class RecordSet:
+    """
+    An in-memory collection of records (dicts or objects), supporting filtering,
+    ordering, slicing and counting according to the query state of a queryset.
+    `search` lookups are served from an inverted index for each field, built when the
+    field is first searched and updated as records are added and removed.
+    """
+
+    def __init__(self, records):
+        self._records = {}  # record key -> record, in insertion order
+        self._keys = {}  # id(record) -> record key
+        self._next_key = 0
+        self._search_indexes = {}
+        for record in records:
+            self.add(record)
+
+    @property
+    def records(self):
+        return list(self._records.values())
+
+    def add(self, record):
+        key = self._next_key
+        self._next_key += 1
+        self._records[key] = record
+        self._keys[id(record)] = key
+        for field, index in self._search_indexes.items():
+            index.add(key, get_value(record, field))
+
+    def remove(self, record):
+        key = self._keys.pop(id(record))
+        del self._records[key]
+        for field, index in self._search_indexes.items():
+            index.remove(key, get_value(record, field))
+
+    def get_search_index(self, field):
+        index = self._search_indexes.get(field)
+        if index is None:
+            index = self._search_indexes[field] = SearchIndex()
+            for key, record in self._records.items():
+                index.add(key, get_value(record, field))
+        return index
+
+    def match(self, filters):
+        # Return a list of (key, record) pairs for the matching records, and the search
+        # scores of the matches (or None if there are no search lookups)
+        scores = get_search_scores(filters, self.get_search_index)
+        if scores is None:
+            entries = list(self._records.items())
+        else:
+            # only the records found in the search index need to be considered
+            entries = [(key, self._records[key]) for key in sorted(scores)]
+
+        for key, arg in filters:
+            field, lookup = split_lookup(key)
+            if lookup == "search":
+                continue
+            test = LOOKUPS[lookup]
+            entries = [entry for entry in entries if test(get_value(entry[1], field), arg)]
+        return entries, scores
+
+    def filter(self, filters):
+        return [entry[1] for entry in self.match(filters)[0]]
+
+    def query(self, filters=(), ordering=(), offset=0, limit=None):
+        entries, scores = self.match(filters)
+        stop = None if limit is None else offset + limit
+
+        if ordering:
+            sort_key = get_sort_key_function(ordering, get_value)
+
+            def key(entry):
+                return sort_key(entry[1])
+        elif scores:
+            # order search results by relevance, and then by their original order
+            def key(entry):
+                return (-scores[entry[0]], entry[0])
+        else:
+            key = None
+
+        if key is not None:
+            if stop is not None and stop < len(entries):
+                # only the first `stop` records are needed, so avoid a full sort
+                entries = heapq.nsmallest(stop, entries, key=key)
+            else:
+                entries = sorted(entries, key=key)
+
+        return [entry[1] for entry in entries[offset:stop]]
+
+    def count(self, filters=(), offset=0, limit=None):
+        count = max(0, len(self.match(filters)[0]) - offset)
+        if limit is not None:
+            count = min(count, limit)
+        return count
+
+    def __len__(self):
+        return len(self._records)
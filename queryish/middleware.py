@@ -0,0 +1,15 @@
+from queryish.cache import cache_scope
+
+
+class CacheScopeMiddleware:
+    """
+    Django middleware that evaluates each request within a `cache_scope`, so that API
+    responses are shared between all querysets used by the request and discarded after it.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        with cache_scope():
+            return self.get_response(request)
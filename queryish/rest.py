@@ -1,7 +1,60 @@
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import contextvars
 from functools import cached_property
+import json
+import os
+import threading
 import requests
 
-from queryish import Queryish, VirtualModel
+from queryish import Queryish, VirtualModel, get_current_scope
+from queryish.memory import RecordSet, split_lookup
+
+
+def map_concurrently(func, items, max_workers):
+    """
+    Equivalent to map(func, items), but with up to max_workers calls running concurrently
+    on a thread pool. Results are yielded in order, and no more than max_workers results
+    are held at any one time. Calls run within a copy of the caller's context.
+    """
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = deque()
+        for item in items:
+            pending.append(executor.submit(contextvars.copy_context().run, func, item))
+            if len(pending) >= max_workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+READAHEAD_MAX_WORKERS = 2
+_readahead_executor = None
+_readahead_executor_lock = threading.Lock()
+
+
+def get_readahead_executor():
+    global _readahead_executor
+    with _readahead_executor_lock:
+        if _readahead_executor is None:
+            _readahead_executor = ThreadPoolExecutor(
+                max_workers=READAHEAD_MAX_WORKERS, thread_name_prefix="queryish-readahead"
+            )
+        return _readahead_executor
+
+
+def decode_export_page(source, state, fields, content, start, limit):
+    """
+    Decode a raw API response and build the export records for the slice of its results
+    beginning at `start`. Run in a worker process by APIQuerySet.export; `source` is the
+    model class or (for querysets without a model) the queryset class, and `state` is a
+    dict of queryset attributes to apply.
+    """
+    if isinstance(source, type) and issubclass(source, VirtualModel):
+        queryset = source.objects.clone(**state)
+    else:
+        queryset = source().clone(**state)
+    results = queryset.get_results_from_response(json.loads(content))
+    return queryset.get_export_records(results[start:][:limit], fields)
 
 
 class APIQuerySet(Queryish):
@@ -13,19 +66,53 @@ class APIQuerySet(Queryish):
     offset_query_param = "offset"
     page_query_param = "page"
     ordering_query_param = "ordering"
+    fields_query_param = None
+    omit_query_param = None
     model = None
     page_size = None
+    supports_descending_ordering = True
+    max_concurrent_requests = 1
+    block_size = None
+    keyset_pagination = False
+    client_side_filtering = False
+    keyset_after_query_param = "%s__gt"
+    keyset_before_query_param = "%s__lt"
+    identity_map = None
+    in_bulk_query_param = None
+    in_bulk_batch_size = 100
+    identity_map_accepts_list_records = None
+    aggregate_url = None
+    aggregate_query_param = None
+    batch_url = None
+    batch_max_requests = 20
+    readahead = False
+    readahead_previous = False
     http_headers = {"Accept": "application/json"}
 
     def __init__(self):
         super().__init__()
         self._responses = {}  # cache for API responses
+        self._keyset_boundaries = {}  # ordering keys at known offsets, for keyset pagination
+        self._record_sets = {}  # full collections fetched for client-side filtering
+        self._readahead_futures = {}  # response cache key -> (query, Future) for readahead
+
+    def __getstate__(self):
+        # drop cached API responses, which are much larger than the evaluated results
+        state = super().__getstate__()
+        state["_responses"] = {}
+        state["_keyset_boundaries"] = {}
+        state["_record_sets"] = {}
+        state["_readahead_futures"] = {}
+        return state
 
     @cached_property
     def filter_field_aliases(self):
         return {"pk": self.pk_field_name}
 
     def filter_is_valid(self, key, val):
+        if self.uses_client_side_filtering():
+            # validate the field name of lookups such as name__icontains
+            key = split_lookup(key)[0]
         if key in self.filter_field_aliases:
             key = self.filter_field_aliases[key]
         return super().filter_is_valid(key, val)
@@ -45,135 +132,879 @@ class APIQuerySet(Queryish):
                 params[key] = val
         return params
 
+    def get_source_key(self, field_name):
+        # map a model field name to the top-level key it is read from in API records
+        if self.model:
+            field_spec = self.model._meta.get_field(field_name)
+            if field_spec is not None:
+                return field_spec.source_path[0]
+        return field_name
+
+    def get_projection_source_keys(self):
+        # return the list of record keys to keep for only(), or to drop for defer()
+        if self.only_fields is not None:
+            fields = list(self.only_fields)
+            if self.pk_field_name not in fields:
+                fields.insert(0, self.pk_field_name)
+        else:
+            fields = self.deferred_fields
+        return list(dict.fromkeys(self.get_source_key(field) for field in fields))
+
+    def get_projection_query_dict(self):
+        # build the sparse fieldset parameters corresponding to any only() / defer() calls
+        params = {}
+        if self.only_fields is not None:
+            if self.fields_query_param:
+                params[self.fields_query_param] = ",".join(self.get_projection_source_keys())
+        elif self.deferred_fields:
+            if self.omit_query_param:
+                params[self.omit_query_param] = ",".join(self.get_projection_source_keys())
+            elif self.fields_query_param and self.model:
+                params[self.fields_query_param] = ",".join(dict.fromkeys(
+                    self.get_source_key(field) for field in self.model._meta.fields
+                    if field not in self.deferred_fields
+                ))
+        return params
+
+    def apply_projection(self, val):
+        # strip out any fields excluded by only() / defer(), in case the API ignored
+        # the sparse fieldset parameters (or they were not configured)
+        if not isinstance(val, dict):
+            return val
+        if self.only_fields is not None:
+            keys = self.get_projection_source_keys()
+            return {key: value for key, value in val.items() if key in keys}
+        elif self.deferred_fields:
+            keys = self.get_projection_source_keys()
+            return {key: value for key, value in val.items() if key not in keys}
+        return val
+
     def get_instance(self, val):
+        if self.only_fields is not None or self.deferred_fields:
+            val = self.apply_projection(val)
         if self.model:
             return self.model.from_query_data(val)
         else:
             return val
 
+    def get_instances(self, vals):
+        if type(self).get_instance is not APIQuerySet.get_instance:
+            # get_instance has been overridden, so we must call it for each record
+            instances = [self.get_instance(val) for val in vals]
+        elif self.only_fields is not None or self.deferred_fields:
+            vals = [self.apply_projection(val) for val in vals]
+            instances = self.model.from_query_data_many(vals) if self.model else vals
+        elif self.model:
+            instances = self.model.from_query_data_many(vals)
+        else:
+            instances = vals
+
+        self.add_to_identity_map(instances)
+        return instances
+
     def get_individual_instance(self, val):
+        if self.only_fields is not None or self.deferred_fields:
+            val = self.apply_projection(val)
         if self.model:
-            return self.model.from_individual_data(val)
+            instance = self.model.from_individual_data(val)
         else:
+            instance = val
+
+        self.add_to_identity_map([instance], detail=True)
+        return instance
+
+    def get_instance_pk(self, instance):
+        if isinstance(instance, dict):
+            return instance.get(self.pk_field_name)
+        return getattr(instance, "pk", None)
+
+    def add_to_identity_map(self, instances, detail=False):
+        identity_map = self.get_identity_map()
+        if identity_map is None or self.only_fields is not None or self.deferred_fields:
+            # instances with deferred fields are incomplete, so should not be reused
+            return
+        for instance in instances:
+            pk = self.get_instance_pk(instance)
+            if pk is not None:
+                identity_map.add(pk, instance, detail=detail)
+
+    def get_identity_map(self):
+        if self.identity_map is None:
+            scope = get_current_scope()
+            if scope is not None:
+                # within a cache scope, every queryset has an identity map for its model
+                return scope.get_identity_map((self.model, self.base_url))
+        return self.identity_map
+
+    def get_from_identity_map(self, pk):
+        identity_map = self.get_identity_map()
+        if identity_map is None:
+            return None
+        accepts_list_records = self.identity_map_accepts_list_records
+        if accepts_list_records is None:
+            # without a detail URL, a get() would be served from a listing anyway
+            accepts_list_records = not self.detail_url
+        return identity_map.lookup(pk, detail=not accepts_list_records)
+
+    def get_pk_lookup(self, kwargs):
+        # if kwargs consists of a single lookup on the pk, return its value; otherwise None
+        if len(kwargs) != 1:
+            return None
+        [(key, val)] = kwargs.items()
+        if self.filter_field_aliases.get(key, key) == self.pk_field_name:
             return val
+        return None
+
+    def is_unconstrained(self):
+        return (
+            not self.filters and self.offset == 0 and self.limit is None
+            and self.only_fields is None and not self.deferred_fields
+        )
+
+    def get(self, **kwargs):
+        pk = self.get_pk_lookup(kwargs)
+        if pk is not None and self.is_unconstrained():
+            instance = self.get_from_identity_map(pk)
+            if instance is not None:
+                return instance
+        return super().get(**kwargs)
 
     def get_detail_url(self, pk):
         return self.detail_url % pk
 
-    def run_query(self):
+    def get_detail_lookup_pk(self, params):
+        # if the only filter is the pk, we can use the detail view
+        # to fetch the single instance
+        if list(params.keys()) == [self.pk_field_name] and self.detail_url:
+            return params[self.pk_field_name]
+        return None
+
+    def get_query_params(self):
+        # the full set of query params, other than pagination, for fetching a listing
         params = self.get_filters_as_query_dict()
 
-        if list(params.keys()) == [self.pk_field_name] and self.detail_url:
-            # if the only filter is the pk, we can use the detail view
-            # to fetch the single instance
-            yield self.get_individual_instance(self.fetch_api_response(
-                url=self.get_detail_url(params[self.pk_field_name]),
-            ))
-            return
+        # sparse fieldset parameters are added after the detail_url check, so that
+        # they form part of the response cache key but not the filter set
+        params.update(self.get_projection_query_dict())
 
         if self.ordering:
             params[self.ordering_query_param] = ",".join(self.ordering)
+        return params
 
+    def get_page_params(self, offset, limit, exact=False):
+        # the pagination query params for fetching results starting at `offset`
         if self.pagination_style == "offset-limit":
-            offset = self.offset
-            limit = self.limit
-            returned_result_count = 0
+            if self.block_size:
+                # fetch the whole aligned block containing `offset`, so that the
+                # response can be reused by any other slice that overlaps it. If `exact`
+                # is true, fetch a block's worth of results starting at `offset` instead
+                return {
+                    self.offset_query_param: offset if exact else self.get_page_start(offset),
+                    self.limit_query_param: self.block_size,
+                }
+            return {
+                self.offset_query_param: offset,
+                self.limit_query_param: limit,
+            }
+        else:
+            return {
+                self.page_query_param: 1 + offset // self.page_size,
+            }
 
-            while True:
-                # continue fetching pages of results until we reach either
-                # the end of the result set or the end of the slice
-                response_json = self.fetch_api_response(params={
-                    self.offset_query_param: offset,
-                    self.limit_query_param: limit,
-                    **params,
-                })
-                results_page = self.get_results_from_response(response_json)
-                for result in results_page:
-                    yield self.get_instance(result)
-                    returned_result_count += 1
-                    if limit is not None and returned_result_count >= limit:
-                        return
-                if len(results_page) == 0 or offset + len(results_page) >= response_json["count"]:
-                    # we've reached the end of the result set
-                    return
+    def is_short_block(self, page_start, page_length, offset, count):
+        # true if the block fetched for `offset` ended before reaching it, without being the
+        # end of the result set - as happens when the API caps the limit below block_size
+        return bool(
+            self.pagination_style == "offset-limit" and self.block_size
+            and page_start + page_length <= offset and (count is None or offset < count)
+        )
 
-                offset += len(results_page)
-                if limit is not None:
-                    limit -= len(results_page)
-        elif self.pagination_style == "page-number":
+    def get_page_start(self, offset):
+        # the offset of the first result in the page fetched for `offset`
+        if self.pagination_style == "page-number":
+            return offset - offset % self.page_size
+        elif self.pagination_style == "offset-limit" and self.block_size:
+            return offset - offset % self.block_size
+        return offset
+
+    def uses_client_side_filtering(self):
+        return self.client_side_filtering and self.pagination_style is None
+
+    def get_record_set(self, cache=True):
+        # fetch the complete, unfiltered collection as a RecordSet
+        url = self.base_url
+        record_sets = self.get_record_sets()
+        if url not in record_sets or self.refresh_cache:
+            response_json = self.fetch_api_response(url=url, cache=cache)
+            record_set = RecordSet(self.get_results_from_response(response_json))
+            if not cache:
+                return record_set
+            record_sets[url] = record_set
+        return record_sets[url]
+
+    def get_record_sets(self):
+        # the dict of RecordSets fetched for client-side filtering, keyed by URL
+        scope = get_current_scope()
+        if scope is not None:
+            return scope.record_sets
+        return self._record_sets
+
+    def get_client_side_filters(self):
+        filters = []
+        for key, val in self.filters:
+            # map the field part of lookups such as pk__in to the real field name
+            field, lookup = split_lookup(key)
+            filters.append(("%s__%s" % (self.filter_field_aliases.get(field, field), lookup), val))
+        return filters
+
+    def run_query(self):
+        pk = self.get_detail_lookup_pk(self.get_filters_as_query_dict())
+        if pk is not None and not self.uses_client_side_filtering():
+            yield self.get_individual_instance(self.fetch_api_response(
+                url=self.get_detail_url(pk),
+                params=self.get_projection_query_dict(),
+            ))
+            return
+
+        result_count = 0
+        for results_page in self.iter_result_pages():
+            result_count += len(results_page)
+            yield from self.get_instances(results_page)
+
+        if self.readahead and self.limit is not None and result_count == self.limit:
+            # a full slice was returned, so there may be more results after it
+            self.schedule_readahead()
+
+    def get_readahead_querysets(self):
+        # the slices either side of this one, which are likely to be requested next
+        querysets = [self.clone(offset=self.offset + self.limit)]
+        if self.readahead_previous and self.offset > 0:
+            querysets.append(self.clone(
+                offset=max(0, self.offset - self.limit), limit=min(self.limit, self.offset)
+            ))
+        return querysets
+
+    def schedule_readahead(self):
+        """
+        Start fetching the API responses for the slices returned by get_readahead_querysets
+        in the background, on a shared pool of READAHEAD_MAX_WORKERS threads. Any readahead
+        for other slices of the same query that has not yet started is cancelled. Within a
+        cache scope, the responses are stored in the scope's response cache.
+        """
+        query = (self.filters, self.ordering)
+        requests_by_key = {}
+        for queryset in self.get_readahead_querysets():
+            for request in queryset.explain()["requests"]:
+                if not request["cached"]:
+                    key = self.get_response_cache_key(request["url"], request["params"])
+                    requests_by_key[key] = request
+
+        futures = self._readahead_futures
+        for key, (future_query, future) in list(futures.items()):
+            if future_query == query and key not in requests_by_key and future.cancel():
+                futures.pop(key, None)
+
+        executor = get_readahead_executor()
+        scope = get_current_scope()
+        for key, request in requests_by_key.items():
+            if key in futures:
+                continue
+            # run in a copy of the current context, so that the response is stored in the
+            # same response cache as the request it stands in for
+            future = executor.submit(
+                contextvars.copy_context().run,
+                self.fetch_readahead_response, request["url"], request["params"],
+            )
+            futures[key] = (query, future)
+            future.add_done_callback(lambda future, key=key: futures.pop(key, None))
+            if scope is not None:
+                # cancelled if the scope ends before the readahead starts
+                scope.add_readahead_future(future)
+
+    def iter_result_pages(self, cache=True):
+        """
+        Yield lists of raw result records, fetching as many pages as necessary to cover
+        the current slice. If `cache` is false, responses not already in the response
+        cache will be fetched without being added to it.
+        """
+        if self.uses_client_side_filtering():
+            yield self.get_record_set(cache=cache).query(
+                self.get_client_side_filters(), self.ordering, self.offset, self.limit
+            )
+            return
+
+        params = self.get_query_params()
+
+        if self.pagination_style == "offset-limit" or self.pagination_style == "page-number":
             offset = self.offset
             limit = self.limit
-            returned_result_count = 0
+
+            keyset_field = self.get_keyset_field()
 
             while True:
                 # continue fetching pages of results until we reach either
                 # the end of the result set or the end of the slice
-                page = 1 + offset // self.page_size
-                response_json = self.fetch_api_response(params={
-                    self.page_query_param: page,
-                    **params,
-                })
-                results_page = self.get_results_from_response(response_json)
-                results_page_offset = offset % self.page_size
-                for result in results_page[results_page_offset:]:
-                    yield self.get_instance(result)
-                    returned_result_count += 1
-                    if self.limit is not None and returned_result_count >= self.limit:
-                        return
-                if len(results_page) == 0 or offset + len(results_page) >= response_json["count"]:
+                results_page, page_start, count = self.fetch_results_page(
+                    offset, limit, params, cache=cache, keyset_field=keyset_field
+                )
+                if self._count is None:
+                    # record the size of the slice, for count() and to_numpy() to reuse
+                    self._count = self.get_slice_count(count)
+                results = results_page[offset - page_start:]
+                if limit is not None:
+                    results = results[:limit]
+                if results:
+                    yield results
+
+                if not results or page_start + len(results_page) >= count:
                     # we've reached the end of the result set
                     return
 
-                offset += len(results_page)
+                offset += len(results)
                 if limit is not None:
-                    limit -= len(results_page)
+                    limit -= len(results)
+                    if limit <= 0:
+                        return
+
+                if self.max_concurrent_requests > 1 and not keyset_field:
+                    # we now know the size of the result set and the page length,
+                    # so the remaining pages can be requested concurrently
+                    yield from self.iter_result_pages_concurrently(
+                        params, offset, limit, count, len(results_page), cache
+                    )
+                    return
         else:
-            response_json = self.fetch_api_response(params=params)
+            response_json = self.fetch_api_response(params=params, cache=cache)
             if self.limit is None:
                 stop = None
             else:
                 stop = self.offset + self.limit
             results = self.get_results_from_response(response_json)
-            for item in results[self.offset:stop]:
-                yield self.get_instance(item)
+            yield results[self.offset:stop]
 
-    def run_count(self):
-        params = self.get_filters_as_query_dict()
+    def get_slice_count(self, count):
+        # count is the full result set without considering slicing;
+        # we need to adjust it to the slice
+        count = max(0, count - self.offset)
+        if self.limit is not None:
+            count = min(count, self.limit)
+        return count
 
-        if self.pagination_style == "offset-limit" or self.pagination_style == "page-number":
-            if self.pagination_style == "offset-limit":
-                params[self.limit_query_param] = 1
+    def fetch_results_page(self, offset, limit, params, cache=True, keyset_field=None):
+        """
+        Fetch the page of results beginning at, or containing, `offset`. Return a tuple of
+        the list of raw records in the page, the offset of the first record in the page, and
+        the total size of the result set.
+        """
+        request_params, base_offset = self.get_page_request_params(
+            offset, limit, params, keyset_field=keyset_field
+        )
+        response_json = self.fetch_api_response(params=request_params, cache=cache)
+        results_page = self.get_results_from_response(response_json)
+
+        if not keyset_field:
+            page_start = self.get_page_start(offset)
+            if self.is_short_block(page_start, len(results_page), offset, response_json["count"]):
+                # fetch from `offset` itself, rather than from the start of its block
+                response_json = self.fetch_api_response(params={
+                    **self.get_page_params(offset, limit, exact=True), **params,
+                }, cache=cache)
+                results_page = self.get_results_from_response(response_json)
+                page_start = offset
+            return results_page, page_start, response_json["count"]
+
+        if results_page:
+            # record the key of the last result as a new boundary
+            field_name = keyset_field.lstrip("-")
+            boundaries = self.get_keyset_boundaries(params)
+            boundaries[offset + len(results_page)] = results_page[-1].get(
+                self.filter_field_aliases.get(field_name, field_name)
+            )
+        return results_page, offset, base_offset + response_json["count"]
+
+    def get_page_request_params(self, offset, limit, params, keyset_field=None):
+        """
+        Return a tuple of the query params to request for the page of results beginning at,
+        or containing, `offset`, and the offset that the response's count is relative to.
+        """
+        if not keyset_field:
+            return {**self.get_page_params(offset, limit), **params}, 0
+
+        # Rather than requesting `offset` directly, find the nearest preceding page boundary
+        # whose ordering key is known, and request the results after that key.
+        boundaries = self.get_keyset_boundaries(params)
+        base_offset = max(boundary for boundary in boundaries if boundary <= offset)
+        if base_offset:
+            filter_params = self.get_keyset_filter_params(keyset_field, boundaries[base_offset])
+        else:
+            filter_params = {}
+
+        return {
+            self.offset_query_param: offset - base_offset,
+            self.limit_query_param: limit,
+            **params,
+            **filter_params,
+        }, base_offset
+
+    def get_keyset_boundaries(self, params):
+        # mapping of offset to the ordering key of the record preceding it
+        return self._keyset_boundaries.setdefault(tuple(sorted(params.items())), {0: None})
+
+    def get_keyset_field(self):
+        # return the ordering field to use for keyset pagination, if applicable
+        if (
+            self.keyset_pagination and self.pagination_style == "offset-limit"
+            and len(self.ordering) == 1
+        ):
+            return self.ordering[0]
+        return None
+
+    def get_keyset_filter_params(self, keyset_field, value):
+        # the filter that selects records after `value` in the ordering
+        if keyset_field.startswith("-"):
+            template = self.keyset_before_query_param
+        else:
+            template = self.keyset_after_query_param
+        field_name = keyset_field.lstrip("-")
+        return {template % self.filter_field_aliases.get(field_name, field_name): value}
+
+    def get_page_requests(self, offset, limit, count, page_length):
+        """
+        Return a list of (offset, page start, limit) tuples for the requests needed to fetch
+        results from `offset` onwards, once the result count and page length are known.
+        """
+        stop = count if limit is None else min(count, offset + limit)
+        # if the API returns less than a block at a time, blocks cannot be fetched whole,
+        # so each page is fetched from its exact offset
+        exact = bool(
+            self.pagination_style == "offset-limit" and self.block_size
+            and page_length < self.block_size
+        )
+        requests = []
+        while offset < stop:
+            page_start = offset if exact else self.get_page_start(offset)
+            page_stop = min(page_start + page_length, stop)
+            requests.append((offset, page_start, page_stop - offset))
+            offset = page_stop
+        return requests
+
+    def iter_result_pages_concurrently(self, params, offset, limit, count, page_length, cache=True):
+        requests = self.get_page_requests(offset, limit, count, page_length)
+
+        def fetch_page(request):
+            offset, page_start, page_limit = request
+            response_json = self.fetch_api_response(params={
+                **self.get_page_params(offset, page_limit, exact=page_start == offset),
+                **params,
+            }, cache=cache)
+            results_page = self.get_results_from_response(response_json)
+            return results_page[offset - page_start:][:page_limit]
+
+        for results in map_concurrently(fetch_page, requests, self.max_concurrent_requests):
+            if results:
+                yield results
+
+    def export(self, fields=None, processes=None):
+        """
+        Yield the results of this queryset, or if `fields` is given, dicts of the values of
+        those fields, with the decoding of API responses and building of instances spread
+        over a pool of `processes` worker processes (defaulting to the number of CPUs).
+        Pages continue to be fetched, up to `max_concurrent_requests` at a time, while
+        earlier ones are decoded. Results are yielded in order, and are not cached.
+
+        The model (or queryset class, if there is no model) must be importable by the
+        worker processes. Only page-numbered and offset-limit paginated listings are
+        decoded in parallel; other queries are decoded in this process.
+        """
+        if self._results is not None:
+            # already evaluated, so there is nothing to fetch or decode
+            if fields is None:
+                yield from self._results
+            else:
+                yield from self.get_export_records(self._results, fields)
+            return
+
+        params = self.get_query_params()
+        # a pk lookup is served from the detail URL (see stream_record_pages)
+        detail = (
+            not self.uses_client_side_filtering()
+            and self.get_detail_lookup_pk(self.get_filters_as_query_dict()) is not None
+        )
+        if (
+            self.uses_client_side_filtering() or self.get_keyset_field() or detail
+            or (self.pagination_style != "offset-limit" and self.pagination_style != "page-number")
+        ):
+            for results_page in self.stream_record_pages():
+                yield from self.get_export_records(results_page, fields, detail=detail)
+            return
+
+        # fetch the first page here, to find the size of the result set and the page length
+        offset = self.offset
+        limit = self.limit
+        results_page, page_start, count = self.fetch_results_page(
+            offset, limit, params, cache=False
+        )
+        results = results_page[offset - page_start:]
+        if limit is not None:
+            results = results[:limit]
+        yield from self.get_export_records(results, fields)
+
+        if not results or page_start + len(results_page) >= count:
+            return
+        offset += len(results)
+        if limit is not None:
+            limit -= len(results)
+            if limit <= 0:
+                return
+
+        def fetch_page_content(request):
+            offset, page_start, page_limit = request
+            return self.fetch_api_response_content(params={
+                **self.get_page_params(offset, page_limit),
+                **params,
+            })
+
+        requests = self.get_page_requests(offset, limit, count, len(results_page))
+        source = self.model or type(self)
+        state = {"only_fields": self.only_fields, "deferred_fields": self.deferred_fields}
+        processes = processes or os.cpu_count() or 1
+
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            pending = deque()
+            contents = map_concurrently(fetch_page_content, requests, self.max_concurrent_requests)
+            for (offset, page_start, page_limit), content in zip(requests, contents):
+                pending.append(executor.submit(
+                    decode_export_page, source, state, fields, content,
+                    offset - page_start, page_limit,
+                ))
+                # keep enough pages queued to occupy every worker
+                while len(pending) > processes * 2:
+                    yield from pending.popleft().result()
+            while pending:
+                yield from pending.popleft().result()
+
+    def get_export_records(self, records, fields=None, detail=False):
+        # build the results for a list of raw records, as returned by export(). `detail`
+        # indicates that the records come from the detail URL rather than a listing
+        if fields is None:
+            if detail:
+                return [self.get_individual_instance(record) for record in records]
+            return self.get_instances(records)
+        return [
+            {field: self.get_record_value(record, field) for field in fields}
+            for record in records
+        ]
+
+    def stream_record_pages(self, page_size=None):
+        # stream the raw records from the API responses, a page at a time. Pages follow
+        # the API's pagination, split into lists of at most `page_size` records if given
+        if self._results is not None:
+            # reuse the evaluated results rather than fetching them again
+            yield from super().stream_record_pages(page_size or len(self._results) or 1)
+            return
+
+        pk = self.get_detail_lookup_pk(self.get_filters_as_query_dict())
+        if pk is not None and not self.uses_client_side_filtering():
+            pages = [[self.fetch_api_response(
+                url=self.get_detail_url(pk),
+                params=self.get_projection_query_dict(),
+                cache=False,
+            )]]
+        else:
+            pages = self.iter_result_pages(cache=False)
+
+        for page in pages:
+            if page_size is None:
+                yield page
             else:
-                params[self.page_query_param] = 1
+                for i in range(0, len(page), page_size):
+                    yield page[i:i + page_size]
 
-            response_json = self.fetch_api_response(params=params)
-            count = response_json["count"]
-            # count is the full result set without considering slicing;
-            # we need to adjust it to the slice
-            if self.limit is not None:
-                count = min(count, self.limit)
-            count = max(0, count - self.offset)
-            return count
+    def get_record_value(self, record, field):
+        if isinstance(record, dict):
+            field = self.filter_field_aliases.get(field, field)
+            if self.model:
+                # use the model's field declaration to locate and convert the value
+                field_spec = self.model._meta.get_field(field)
+                if field_spec is not None:
+                    return field_spec.get_value(record)
+            return record.get(field)
+        return super().get_record_value(record, field)
+
+    def run_aggregate(self, aggregates):
+        if self.aggregate_query_param and self.offset == 0 and self.limit is None:
+            # let the API compute the aggregates
+            params = self.get_filters_as_query_dict()
+            params[self.aggregate_query_param] = self.get_aggregate_query_value(aggregates)
+            response_json = self.fetch_api_response(url=self.aggregate_url, params=params)
+            return self.get_aggregates_from_response(response_json, aggregates)
+
+        return super().run_aggregate(aggregates)
+
+    def get_aggregate_query_value(self, aggregates):
+        return ",".join(
+            "%s:%s:%s" % (alias, aggregate.name.lower(), aggregate.field)
+            for alias, aggregate in aggregates.items()
+        )
+
+    def get_aggregates_from_response(self, response, aggregates):
+        return {alias: response[alias] for alias in aggregates}
+
+    def run_count(self):
+        if self.uses_client_side_filtering():
+            return self.get_record_set().count(
+                self.get_client_side_filters(), self.offset, self.limit
+            )
+
+        if self.pagination_style == "offset-limit" or self.pagination_style == "page-number":
+            response_json = self.fetch_api_response(params=self.get_count_params())
+            return self.get_slice_count(response_json["count"])
 
         else:
             # default to standard behaviour of getting all results and counting them
             return super().run_count()
 
-    def fetch_api_response(self, url=None, params=None):
+    def explain(self, count=False):
+        """
+        Describe the HTTP requests that evaluating this queryset (or, if `count` is true,
+        calling count() on it) would make, without making any of them. Returns a dict of:
+
+        * `requests` - a list of dicts of `url`, `params` and `cached`, where `cached`
+          indicates that the response is already in the response cache
+        * `cache_hits` - the number of planned requests that would be served from the cache
+        * `estimated_requests` - the number of planned requests that would hit the API
+        * `complete` - false if the number of further pages cannot be determined without
+          fetching them; in this case `requests` only lists the pages known to be needed
+
+        Pages that are not in the response cache are assumed to be full.
+        """
+        responses = self.get_response_cache()
+        planned = []
+
+        def plan(url, params):
+            key = self.get_response_cache_key(url, params)
+            cached = key in responses
+            planned.append({"url": url, "params": params, "cached": cached})
+            return responses[key] if cached else None
+
+        if count:
+            complete = self.plan_count(plan)
+        else:
+            complete = self.plan_query(plan)
+
+        cache_hits = len([request for request in planned if request["cached"]])
+        return {
+            "requests": planned,
+            "cache_hits": cache_hits,
+            "estimated_requests": len(planned) - cache_hits,
+            "complete": complete,
+        }
+
+    def plan_query(self, plan):
+        # Follow the same steps as run_query, passing each request to `plan` in place of
+        # fetching it. Return false if the plan had to stop short.
+        if self._results is not None or self.get_cached_entry() is not None:
+            return True
+
+        if self.uses_client_side_filtering():
+            if self.base_url not in self.get_record_sets():
+                plan(self.base_url, {})
+            return True
+
+        pk = self.get_detail_lookup_pk(self.get_filters_as_query_dict())
+        if pk is not None:
+            plan(self.get_detail_url(pk), self.get_projection_query_dict())
+            return True
+
+        params = self.get_query_params()
+        if self.pagination_style != "offset-limit" and self.pagination_style != "page-number":
+            plan(self.base_url, params)
+            return True
+
+        offset = self.offset
+        limit = self.limit
+        keyset_field = self.get_keyset_field()
+        count = None
+
+        while True:
+            request_params, base_offset = self.get_page_request_params(
+                offset, limit, params, keyset_field=keyset_field
+            )
+            response_json = plan(self.base_url, request_params)
+            page_start = offset if keyset_field else self.get_page_start(offset)
+
+            if response_json is not None and not keyset_field and self.is_short_block(
+                page_start, len(self.get_results_from_response(response_json)), offset,
+                response_json["count"],
+            ):
+                # as in fetch_results_page, fetch from `offset` itself
+                response_json = plan(self.base_url, {
+                    **self.get_page_params(offset, limit, exact=True), **params,
+                })
+                page_start = offset
+
+            if response_json is not None:
+                page_length = len(self.get_results_from_response(response_json))
+                count = base_offset + response_json["count"]
+            elif self.pagination_style == "page-number":
+                page_length = self.page_size
+            else:
+                page_length = self.block_size or limit
+                if page_length is None:
+                    # an unlimited offset-limit request returns an unknown number of results
+                    return False
+
+            results_length = page_start + page_length - offset
+            if limit is not None:
+                results_length = min(results_length, limit)
+
+            if results_length <= 0 or (count is not None and page_start + page_length >= count):
+                return True
+
+            offset += results_length
+            if limit is not None:
+                limit -= results_length
+                if limit <= 0:
+                    return True
+            elif count is None:
+                # we can't tell whether the result set ends here
+                return False
+
+    def plan_count(self, plan):
+        # Follow the same steps as run_count, passing each request to `plan` in place of
+        # fetching it
+        if (
+            self._count is not None or self._results is not None
+            or self.get_cached_entry() is not None
+        ):
+            return True
+
+        if self.uses_client_side_filtering():
+            if self.base_url not in self.get_record_sets():
+                plan(self.base_url, {})
+            return True
+
+        if self.pagination_style == "offset-limit" or self.pagination_style == "page-number":
+            plan(self.base_url, self.get_count_params())
+            return True
+
+        # counting falls back on evaluating the queryset
+        return self.plan_query(plan)
+
+    def get_count_params(self):
+        # the query params for the request that run_count reads the total count from
+        params = self.get_filters_as_query_dict()
+        if self.pagination_style == "offset-limit" and self.block_size:
+            # fetch the block that iterating over the queryset would start with,
+            # so that the response is shared between count() and iteration
+            params = {**self.get_page_params(self.offset, None), **self.get_query_params()}
+        elif self.pagination_style == "offset-limit":
+            params[self.limit_query_param] = 1
+        else:
+            params[self.page_query_param] = 1
+        return params
+
+    def get_response_cache(self):
+        # the dict of API responses, keyed by get_response_cache_key; within a cache scope,
+        # this is shared with all other querysets and discarded at the end of the scope
+        scope = get_current_scope()
+        if scope is not None:
+            return scope.responses
+        return self._responses
+
+    def get_response_cache_key(self, url, params):
         # construct a hashable key for the params
+        return tuple([url] + sorted(params.items()))
+
+    def fetch_api_response(self, url=None, params=None, cache=True):
         if url is None:
             url = self.base_url
 
         if params is None:
             params = {}
-        key = tuple([url] + sorted(params.items()))
-        if key not in self._responses:
-            self._responses[key] = requests.get(
-                url,
-                params=params,
-                headers=self.http_headers,
-            ).json()
-        return self._responses[key]
+        responses = self.get_response_cache()
+        key = self.get_response_cache_key(url, params)
+        if key in responses and not self.refresh_cache:
+            return responses[key]
+
+        readahead = self._readahead_futures.get(key)
+        if readahead is not None and not self.refresh_cache:
+            # the response is already being fetched in the background
+            try:
+                return readahead[1].result()
+            except Exception:
+                # fall back on fetching it here
+                pass
+
+        response_json = self.request_api_response(url, params)
+        if cache:
+            responses[key] = response_json
+        return response_json
+
+    def request_api_response(self, url, params):
+        # make an API request, without consulting the response cache
+        return requests.get(
+            url,
+            params=params,
+            headers=self.http_headers,
+        ).json()
+
+    def fetch_readahead_response(self, url, params):
+        # fetch a response into the response cache ahead of it being needed
+        response_json = self.request_api_response(url, params)
+        scope = get_current_scope()
+        # a response fetched after its cache scope has ended would never be used
+        if scope is None or not scope.closed:
+            self.get_response_cache()[self.get_response_cache_key(url, params)] = response_json
+        return response_json
+
+    def fetch_api_response_content(self, url=None, params=None):
+        # fetch the undecoded body of an API response, bypassing the response cache
+        if url is None:
+            url = self.base_url
+        return requests.get(url, params=params or {}, headers=self.http_headers).content
+
+    def fetch_batch(self, batch):
+        """
+        Make a single request to `batch_url` for a list of (request, querysets) pairs, where
+        each request is a dict of `url` and `params` as returned by explain(), and store
+        each response in the response cache of the corresponding querysets. Return the
+        number of requests that succeeded.
+        """
+        response_json = requests.post(
+            self.batch_url,
+            json=self.get_batch_request_body([request for request, querysets in batch]),
+            headers=self.http_headers,
+        ).json()
+        succeeded = 0
+        for (request, querysets), body in zip(batch, self.get_batch_response_bodies(response_json)):
+            if body is None:
+                continue
+            for queryset in querysets:
+                key = queryset.get_response_cache_key(request["url"], request["params"])
+                queryset.get_response_cache()[key] = body
+            succeeded += 1
+        return succeeded
+
+    def get_batch_request_body(self, batch_requests):
+        # the JSON body of a batch request, for a list of dicts of `url` and `params`
+        return {"requests": [
+            {
+                "method": "GET",
+                "url": request["url"],
+                "params": {
+                    key: val for key, val in request["params"].items() if val is not None
+                },
+            }
+            for request in batch_requests
+        ]}
+
+    def get_batch_response_bodies(self, response):
+        # the response body for each request in a batch, or None where it failed
+        return [
+            item.get("body") if item.get("status", 200) == 200 else None
+            for item in response["responses"]
+        ]
 
     def get_results_from_response(self, response):
         if self.pagination_style == "offset-limit" or self.pagination_style == "page-number":
@@ -182,10 +1013,86 @@ class APIQuerySet(Queryish):
             return response
 
     def in_bulk(self, id_list=None, field_name="pk"):
-        return {
-            id: self.get(**{field_name: id})
-            for id in (id_list or [])
-        }
+        id_list = list(id_list or [])
+        if self.filter_field_aliases.get(field_name, field_name) != self.pk_field_name:
+            return {
+                id: self.get(**{field_name: id})
+                for id in id_list
+            }
+
+        results = {}
+        if self.is_unconstrained():
+            for id in id_list:
+                instance = self.get_from_identity_map(id)
+                if instance is not None:
+                    results[id] = instance
+        missing_ids = [id for id in id_list if id not in results]
+        if not missing_ids:
+            return results
+
+        if self.in_bulk_query_param:
+            # fetch the records in batches through a multi-id filter on the listing endpoint
+            for i in range(0, len(missing_ids), self.in_bulk_batch_size):
+                batch_ids = missing_ids[i:i + self.in_bulk_batch_size]
+                qs = self.clone(filters=self.filters.add(
+                    self.in_bulk_query_param, ",".join(str(id) for id in batch_ids)
+                ))
+                for instance in qs:
+                    results[self.get_instance_pk(instance)] = instance
+        elif self.max_concurrent_requests > 1:
+            instances = map_concurrently(
+                lambda id: self.get(pk=id), missing_ids, self.max_concurrent_requests
+            )
+            results.update(zip(missing_ids, instances))
+        else:
+            for id in missing_ids:
+                results[id] = self.get(pk=id)
+        return results
+
+
+def fetch_batched(*items):
+    """
+    Fetch the API responses needed to evaluate the given querysets (or, where a queryset's
+    `count` method is passed, to count it) by combining them into requests to each
+    queryset's `batch_url` endpoint, up to `batch_max_requests` at a time. The responses
+    are stored in the querysets' response caches, so that evaluating them afterwards does
+    not make any further requests. Querysets without a `batch_url` are left unchanged.
+    """
+    plans = []
+    for item in items:
+        if isinstance(item, APIQuerySet):
+            plans.append((item, False))
+        elif isinstance(getattr(item, "__self__", None), APIQuerySet) and item.__name__ == "count":
+            plans.append((item.__self__, True))
+        else:
+            raise TypeError(
+                "fetch_batched expects APIQuerySets or their count methods, not %r" % item
+            )
+
+    while True:
+        # Plan the requests that are still needed. Where the number of pages is not yet
+        # known, further requests may be planned on the next round.
+        batches = {}
+        for queryset, count in plans:
+            if not queryset.batch_url:
+                continue
+            for request in queryset.explain(count=count)["requests"]:
+                if request["cached"]:
+                    continue
+                key = queryset.get_response_cache_key(request["url"], request["params"])
+                request, querysets = batches.setdefault(queryset.batch_url, {}).setdefault(
+                    key, (request, [])
+                )
+                querysets.append(queryset)
+
+        succeeded = 0
+        for batch in batches.values():
+            batch = list(batch.values())
+            queryset = batch[0][1][0]
+            for i in range(0, len(batch), queryset.batch_max_requests):
+                succeeded += queryset.fetch_batch(batch[i:i + queryset.batch_max_requests])
+        if not succeeded:
+            return
 
 
 class APIModel(VirtualModel):
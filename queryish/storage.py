@@ -0,0 +1,174 @@
+from array import array
+import mmap
+import pickle
+import tempfile
+import weakref
+
+
+class SpillFile:
+    """
+    A temporary file holding pickled items, with a memory map for reading them back.
+    """
+
+    def __init__(self):
+        self.file = tempfile.TemporaryFile()
+        self.size = 0
+        self.map = None
+
+    def write(self, data):
+        self.file.write(data)
+        self.size += len(data)
+
+    def read(self, start, end):
+        if self.map is None or end > len(self.map):
+            # (re)map the file to cover everything written so far
+            self.file.flush()
+            if self.map is not None:
+                self.map.close()
+            self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        return self.map[start:end]
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        self.file.close()
+
+
+class SpillingResultList:
+    """
+    A list-like store of query results, which holds the first `max_in_memory` results in
+    memory and pickles any further ones to a temporary file. Supports appending, iteration,
+    len() and indexing / slicing; the temporary file is deleted when the list is garbage
+    collected.
+    """
+
+    def __init__(self, max_in_memory):
+        self.max_in_memory = max_in_memory
+        self._memory = []
+        self._spill_file = None
+        self._offsets = array("q")  # start position of each spilled item in the file
+
+    def append(self, item):
+        if len(self._memory) < self.max_in_memory:
+            self._memory.append(item)
+            return
+
+        if self._spill_file is None:
+            self._spill_file = SpillFile()
+            weakref.finalize(self, self._spill_file.close)
+        self._offsets.append(self._spill_file.size)
+        self._spill_file.write(pickle.dumps(item, protocol=pickle.HIGHEST_PROTOCOL))
+
+    def _get_spilled(self, index):
+        start = self._offsets[index]
+        if index + 1 < len(self._offsets):
+            end = self._offsets[index + 1]
+        else:
+            end = self._spill_file.size
+        return pickle.loads(self._spill_file.read(start, end))
+
+    @property
+    def spilled_count(self):
+        return len(self._offsets)
+
+    def __len__(self):
+        return len(self._memory) + len(self._offsets)
+
+    def __iter__(self):
+        yield from self._memory
+        for index in range(len(self._offsets)):
+            yield self._get_spilled(index)
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            start, stop, step = key.indices(len(self))
+            if step == 1:
+                # avoid reading spilled items back into memory until they are accessed
+                return ResultListView(self, start, max(start, stop))
+            return [self[index] for index in range(start, stop, step)]
+
+        if key < 0:
+            key += len(self)
+        if key < 0 or key >= len(self):
+            raise IndexError("list index out of range")
+        if key < len(self._memory):
+            return self._memory[key]
+        return self._get_spilled(key - len(self._memory))
+
+    def __repr__(self):
+        return "<SpillingResultList: %d in memory, %d on disk>" % (
+            len(self._memory), len(self._offsets)
+        )
+
+
+class ResultListView:
+    """
+    A read-only view of a range of items in a SpillingResultList, which reads each item
+    from the list as it is accessed rather than copying them.
+    """
+
+    def __init__(self, results, start, stop):
+        self.results = results
+        self.start = start
+        self.stop = stop
+
+    def __len__(self):
+        return self.stop - self.start
+
+    def __iter__(self):
+        for index in range(self.start, self.stop):
+            yield self.results[index]
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            start, stop, step = key.indices(len(self))
+            if step == 1:
+                return ResultListView(self.results, self.start + start, self.start + max(start, stop))
+            return [self[index] for index in range(start, stop, step)]
+
+        if key < 0:
+            key += len(self)
+        if key < 0 or key >= len(self):
+            raise IndexError("list index out of range")
+        return self.results[self.start + key]
+
+    def __repr__(self):
+        return "<ResultListView: items %d to %d of %r>" % (self.start, self.stop, self.results)
+
+
+class LazyRowList:
+    """
+    A list-like store of query results held as compact rows, which are passed to `build`
+    to create each result the first time it is accessed. Supports iteration, len() and
+    indexing / slicing.
+    """
+
+    def __init__(self, rows, build):
+        self.rows = rows
+        self.build = build
+        self._results = [None] * len(rows)
+        self._built = bytearray(len(rows))
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __iter__(self):
+        for index in range(len(self.rows)):
+            yield self[index]
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return [self[index] for index in range(*key.indices(len(self)))]
+
+        if key < 0:
+            key += len(self)
+        if key < 0 or key >= len(self):
+            raise IndexError("list index out of range")
+        if not self._built[key]:
+            self._results[key] = self.build(self.rows[key])
+            self._built[key] = 1
+        return self._results[key]
+
+    def __repr__(self):
+        return "<LazyRowList: %d rows, %d built>" % (len(self.rows), sum(self._built))
@@ -0,0 +1,185 @@
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import threading
+import time
+from urllib.parse import urlparse
+
+
+logger = logging.getLogger(__name__)
+
+
+class WarmQuery:
+    """
+    A queryset registered with a CacheWarmer, along with its refresh schedule and metrics.
+    """
+
+    def __init__(self, queryset, interval, count=False, name=None):
+        self.queryset = queryset
+        self.interval = interval
+        self.count = count
+        self.name = name or "%s:%s" % (type(queryset).__name__, queryset.fingerprint[:12])
+        self.next_refresh = time.monotonic()
+        self.running = False
+        self.last_refresh = None  # wall clock time of the last successful refresh
+        self.last_duration = None
+        self.last_error = None
+        self.refreshes = 0
+        self.failures = 0
+
+    def get_metrics(self):
+        return {
+            "name": self.name,
+            "last_refresh": self.last_refresh,
+            "last_duration": self.last_duration,
+            "last_error": self.last_error,
+            "refreshes": self.refreshes,
+            "failures": self.failures,
+        }
+
+
+class CacheWarmer:
+    """
+    Re-runs registered querysets on a background thread at regular intervals, so that their
+    cached API responses and results are replaced before they expire. Refreshes run on a
+    pool of `max_workers` threads, with at most `max_concurrent_per_host` at a time for any
+    one API host.
+    """
+
+    def __init__(self, interval=300, max_workers=4, max_concurrent_per_host=2):
+        self.interval = interval
+        self.max_workers = max_workers
+        self.max_concurrent_per_host = max_concurrent_per_host
+        self.queries = []
+        self._lock = threading.Lock()
+        self._host_semaphores = {}
+        self._wake = threading.Event()
+        self._stop = None  # Event signalling the current background thread to stop
+        self._thread = None
+        self._executor = None
+
+    def register(self, queryset, interval=None, count=False, name=None):
+        """
+        Register a queryset to be refreshed every `interval` seconds. If `interval` is not
+        given, it defaults to 80% of the timeout of the queryset's result cache, or otherwise
+        the warmer's `interval`. If `count` is true, only the queryset's count is refreshed.
+        """
+        if interval is None:
+            timeout = getattr(queryset.result_cache, "timeout", None)
+            interval = timeout * 0.8 if timeout else self.interval
+        query = WarmQuery(queryset, interval, count=count, name=name)
+        with self._lock:
+            self.queries.append(query)
+        self._wake.set()
+        return query
+
+    def register_model(self, model, interval=None):
+        """
+        Register the querysets given by the `warm_queries` attribute of a model's Meta class,
+        a list of functions that receive the model's base queryset and return a queryset.
+        """
+        return [
+            self.register(get_queryset(model.objects), interval=interval)
+            for get_queryset in model.objects.warm_queries
+        ]
+
+    def unregister(self, query):
+        with self._lock:
+            self.queries.remove(query)
+
+    def get_host(self, queryset):
+        url = getattr(queryset, "base_url", None)
+        return urlparse(url).netloc if url else None
+
+    def get_host_semaphore(self, host):
+        with self._lock:
+            semaphore = self._host_semaphores.get(host)
+            if semaphore is None:
+                semaphore = threading.BoundedSemaphore(self.max_concurrent_per_host)
+                self._host_semaphores[host] = semaphore
+            return semaphore
+
+    def refresh(self, query):
+        """Refresh a registered query immediately, recording the outcome in its metrics"""
+        with self.get_host_semaphore(self.get_host(query.queryset)):
+            start = time.monotonic()
+            try:
+                query.queryset.refresh(count=query.count)
+            except Exception as e:
+                query.failures += 1
+                query.last_error = repr(e)
+                logger.exception("Failed to refresh %s", query.name)
+            else:
+                query.refreshes += 1
+                query.last_error = None
+                query.last_refresh = time.time()
+            finally:
+                query.last_duration = time.monotonic() - start
+                query.running = False
+
+    def refresh_all(self):
+        """Refresh every registered query immediately, in the current thread"""
+        for query in list(self.queries):
+            self.refresh(query)
+
+    def run_pending(self, executor=None):
+        """
+        Start refreshing any queries that are due on the worker pool (or the given executor),
+        and return the number of seconds until the next one is due.
+        """
+        if executor is None:
+            executor = self._executor
+        now = time.monotonic()
+        next_refresh = now + self.interval
+        with self._lock:
+            for query in self.queries:
+                if query.next_refresh <= now and not query.running:
+                    query.running = True
+                    query.next_refresh = now + query.interval
+                    executor.submit(self.refresh, query)
+                next_refresh = min(next_refresh, query.next_refresh)
+        return max(0, next_refresh - now)
+
+    def start(self):
+        """Start the background thread"""
+        if self._thread is not None:
+            return
+        # each run has its own stop event and executor, so that a thread still finishing
+        # after stop(wait=False) is unaffected by a subsequent start()
+        self._stop = threading.Event()
+        self._executor = ThreadPoolExecutor(
+            max_workers=self.max_workers, thread_name_prefix="queryish-warmer"
+        )
+        self._thread = threading.Thread(
+            target=self._run, args=(self._stop, self._executor),
+            name="queryish-warmer", daemon=True,
+        )
+        self._thread.start()
+
+    def stop(self, wait=True):
+        """Stop the background thread, optionally waiting for running refreshes to finish"""
+        if self._thread is None:
+            return
+        thread, executor = self._thread, self._executor
+        self._stop.set()
+        self._wake.set()
+        self._thread = None
+        self._executor = None
+        self._stop = None
+        if wait:
+            thread.join()
+            executor.shutdown(wait=True)
+
+    def _run(self, stop, executor):
+        while not stop.is_set():
+            # clear the wake-up flag first, so that a query registered while we are
+            # scheduling is picked up on the next pass rather than missed
+            self._wake.clear()
+            delay = self.run_pending(executor)
+            if not stop.is_set():
+                self._wake.wait(delay)
+        # the executor is only shut down once this thread can no longer submit to it
+        executor.shutdown(wait=False)
+
+    def get_metrics(self):
+        """Return a list of dicts of the refresh metrics for each registered query"""
+        return [query.get_metrics() for query in self.queries]
@@ -23,8 +23,16 @@ setup(
         "requests>=2.28,<3.0",
     ],
     extras_require={
+        "numpy": [
+            "numpy>=1.21",
+        ],
+        "arrow": [
+            "pyarrow>=10.0",
+        ],
         "testing": [
             "responses>=0.23,<1.0",
+            "numpy>=1.21",
+            "pyarrow>=10.0",
         ]
     },
     classifiers=[
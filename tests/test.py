@@ -1,6 +1,14 @@
-from unittest import TestCase
+import gc
+import os
+import pickle
+import subprocess
+import sys
+import threading
+from unittest import TestCase, mock
 
-from queryish import Queryish
+from queryish import Queryish, ResultCache, gather
+from queryish.memory import RecordSet
+from queryish.storage import SpillingResultList
 
 
 class CounterQuerySetWithoutCount(Queryish):
@@ -46,6 +54,34 @@ class CounterQuerySet(CounterQuerySetWithoutCount):
         return clone
 
 
+class CachedCounterQuerySet(CounterQuerySet):
+    result_cache = ResultCache(timeout=60, max_size=3)
+
+
+class ListQuerySet(Queryish):
+    """
+    A queryset over an in-memory list of dicts, recording the number of results
+    consumed from it
+    """
+    def __init__(self, records):
+        super().__init__()
+        self.records = records
+        self.consumed = []
+
+    def run_query(self):
+        records = self.records
+        for (key, val) in self.filters:
+            records = [r for r in records if r[key] == val]
+        for field in reversed(self.ordering):
+            name = field.lstrip("-")
+            # nulls come last, or first in descending order
+            records = sorted(records, key=lambda r: (r[name] is None, r[name]), reverse=field.startswith("-"))
+        records = records[self.offset:self.offset + self.limit if self.limit else None]
+        for record in records:
+            self.consumed.append(record)
+            yield record
+
+
 class TestQueryish(TestCase):
     def test_get_results_as_list(self):
         qs = CounterQuerySet()
@@ -189,6 +225,62 @@ class TestQueryish(TestCase):
         self.assertEqual(qs[2], 3)
         self.assertEqual(qs.run_query_call_count, 1)
 
+    def test_resume_partial_iteration(self):
+        qs = CounterQuerySet()
+        for i in qs:
+            if i == 2:
+                break
+        self.assertEqual(qs[1], 1)
+        self.assertEqual(qs[4], 4)
+        self.assertEqual(len(qs._result_prefix), 5)
+        self.assertEqual(list(qs[:3]), [0, 1, 2])
+        self.assertEqual(list(qs), list(range(0, 10)))
+        self.assertEqual(len(qs), 10)
+        self.assertEqual(qs.run_query_call_count, 1)
+
+    def test_interleaved_iteration(self):
+        qs = CounterQuerySet(max_count=3)
+        iter1 = iter(qs)
+        iter2 = iter(qs)
+        self.assertEqual(next(iter1), 0)
+        self.assertEqual(list(iter2), [0, 1, 2])
+        self.assertEqual(list(iter1), [1, 2])
+        self.assertEqual(qs.run_query_call_count, 1)
+
+    def test_negative_indexing(self):
+        qs = CounterQuerySet()
+        self.assertEqual(qs[-1], 9)
+        self.assertEqual(qs.run_count_call_count, 1)
+        # only the final item is fetched
+        self.assertEqual(qs.run_query_call_count, 0)
+        with self.assertRaises(IndexError):
+            qs[-11]
+
+        self.assertEqual(list(qs[-3:]), [7, 8, 9])
+        self.assertEqual(list(qs[2:-6]), [2, 3])
+        self.assertEqual(list(qs[4:8][-2:]), [6, 7])
+
+        list(qs)
+        self.assertEqual(qs[-2], 8)
+
+    def test_last(self):
+        qs = CounterQuerySet()
+        self.assertEqual(qs.last(), 9)
+        self.assertEqual(qs[2:5].last(), 4)
+        self.assertEqual(qs[20:30].last(), None)
+
+    def test_last_with_descending_ordering(self):
+        class OrderedListQuerySet(ListQuerySet):
+            supports_descending_ordering = True
+
+        qs = OrderedListQuerySet([{"id": 1}, {"id": 3}, {"id": 2}]).order_by("id")
+        self.assertEqual(qs.last(), {"id": 3})
+        self.assertEqual(qs.consumed, [{"id": 3}])
+        self.assertEqual(list(qs.reverse()), [{"id": 3}, {"id": 2}, {"id": 1}])
+        self.assertEqual(qs.reverse().ordering, ("-id",))
+        with self.assertRaises(TypeError):
+            qs[:2].reverse()
+
     def test_invalid_index_type(self):
         qs = CounterQuerySet()
         with self.assertRaises(TypeError):
@@ -207,3 +299,245 @@ class TestQueryish(TestCase):
         qs = CounterQuerySet()
         self.assertEqual(qs.first(), 0)
         self.assertEqual(qs[20:30].first(), None)
+
+    def test_filter_chain_is_shared(self):
+        qs1 = CounterQuerySet().filter(a=1)
+        qs2 = qs1.filter(b=[2, 3])
+        self.assertEqual(list(qs1.filters), [("a", 1)])
+        self.assertEqual(list(qs2.filters), [("a", 1), ("b", [2, 3])])
+        self.assertIs(qs2.filters.parent, qs1.filters)
+
+    def test_query_key(self):
+        qs1 = CounterQuerySet().filter(a=1).filter(b=[2, 3]).order_by("c")[5:10]
+        qs2 = CounterQuerySet().filter(a=1, b=[2, 3]).order_by("c")[5:10]
+        self.assertEqual(qs1.query_key, qs2.query_key)
+        self.assertEqual(hash(qs1.query_key), hash(qs2.query_key))
+        self.assertEqual(qs1.fingerprint, qs2.fingerprint)
+        self.assertNotEqual(qs1.fingerprint, qs1[1:].fingerprint)
+        self.assertNotEqual(qs1.fingerprint, CounterQuerySet().filter(a=2).fingerprint)
+        self.assertNotEqual(CounterQuerySet().filter(a=1).fingerprint, CounterQuerySet().filter(a="1").fingerprint)
+
+    def test_fingerprint_is_independent_of_hash_seed(self):
+        code = (
+            "from tests.test import CounterQuerySet; "
+            "print(CounterQuerySet().filter(a={'x', 'y', 'z', 1, 2.5}).fingerprint)"
+        )
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        fingerprints = {
+            subprocess.check_output(
+                [sys.executable, "-c", code], cwd=root, env={**os.environ, "PYTHONHASHSEED": seed}
+            )
+            for seed in ["1", "2", "3"]
+        }
+        self.assertEqual(len(fingerprints), 1)
+
+
+class TestResultCache(TestCase):
+    def setUp(self):
+        CachedCounterQuerySet.result_cache.clear()
+
+    def test_results_are_shared_between_querysets(self):
+        qs1 = CachedCounterQuerySet().filter(even=True)[:3]
+        self.assertEqual(list(qs1), [0, 1, 2])
+        self.assertEqual(qs1.run_query_call_count, 1)
+
+        qs2 = CachedCounterQuerySet().filter(even=True)[:3]
+        self.assertEqual(list(qs2), [0, 1, 2])
+        self.assertEqual(qs2.count(), 3)
+        self.assertEqual(qs2.run_query_call_count, 0)
+        self.assertEqual(qs2.run_count_call_count, 0)
+
+    def test_size_limit(self):
+        for i in range(4):
+            list(CachedCounterQuerySet()[i:])
+        self.assertEqual(len(CachedCounterQuerySet.result_cache), 3)
+        self.assertNotIn(CachedCounterQuerySet()[0:].get_result_cache_key(), CachedCounterQuerySet.result_cache)
+        self.assertIn(CachedCounterQuerySet()[3:].get_result_cache_key(), CachedCounterQuerySet.result_cache)
+
+    def test_timeout(self):
+        list(CachedCounterQuerySet())
+        with mock.patch("queryish.cache.time.monotonic", return_value=float("inf")):
+            qs = CachedCounterQuerySet()
+            list(qs)
+            self.assertEqual(qs.run_query_call_count, 1)
+
+    def test_invalidate(self):
+        list(CachedCounterQuerySet().filter(even=True))
+        list(CachedCounterQuerySet().filter(even=False))
+        CachedCounterQuerySet().invalidate_result_cache(even=True)
+        self.assertEqual(len(CachedCounterQuerySet.result_cache), 1)
+
+        qs = CachedCounterQuerySet().filter(even=True)
+        list(qs)
+        self.assertEqual(qs.run_query_call_count, 1)
+
+        CachedCounterQuerySet().invalidate_result_cache()
+        self.assertEqual(len(CachedCounterQuerySet.result_cache), 0)
+
+
+class TestGather(TestCase):
+    def test_gather(self):
+        # each query blocks until all three are running, so this only completes
+        # if they are evaluated concurrently
+        barrier = threading.Barrier(3, timeout=5)
+
+        class BlockingCounterQuerySet(CounterQuerySet):
+            def run_query(self):
+                barrier.wait()
+                return super().run_query()
+
+            def run_count(self):
+                barrier.wait()
+                return super().run_count()
+
+        qs = BlockingCounterQuerySet()
+        top_three = qs[:3]
+        all_results = BlockingCounterQuerySet(max_count=5)
+        results = gather(top_three, qs.count, all_results.first)
+
+        self.assertEqual(results, [top_three, 10, 0])
+        self.assertEqual(top_three._results, [0, 1, 2])
+        self.assertEqual(qs.count(), 10)
+        self.assertEqual(qs.run_count_call_count, 1)
+
+    def test_nested_gather(self):
+        # gather() calls made from within gather() get their own threads, so do not wait
+        # on threads occupied by the outer call
+        def count_both():
+            return sum(gather(CounterQuerySet().count, CounterQuerySet(max_count=5).count))
+
+        with mock.patch("queryish.GATHER_MAX_WORKERS", 1):
+            self.assertEqual(gather(count_both, count_both), [15, 15])
+
+    def test_max_workers(self):
+        thread_names = set()
+        barrier = threading.Barrier(2, timeout=0.2)
+
+        def record_thread():
+            thread_names.add(threading.current_thread().name)
+            try:
+                barrier.wait()
+            except threading.BrokenBarrierError:
+                pass
+
+        with mock.patch("queryish.GATHER_MAX_WORKERS", 1):
+            gather(record_thread, record_thread)
+        self.assertEqual(len(thread_names), 1)
+
+
+class TestUnion(TestCase):
+    def setUp(self):
+        self.europe = ListQuerySet([
+            {"name": "France", "population": 68, "continent": "europe"},
+            {"name": "Germany", "population": 84, "continent": "europe"},
+            {"name": "Iceland", "population": 0.4, "continent": "europe"},
+        ])
+        self.asia = ListQuerySet([
+            {"name": "Japan", "population": 125, "continent": "asia"},
+            {"name": "China", "population": 1412, "continent": "asia"},
+        ])
+
+    def test_union(self):
+        qs = self.europe.union(self.asia)
+        self.assertEqual([c["name"] for c in qs], ["France", "Germany", "Iceland", "Japan", "China"])
+        self.assertEqual(qs.count(), 5)
+
+    def test_ordered_union(self):
+        qs = self.europe.union(self.asia).order_by("-population")
+        self.assertEqual([c["name"] for c in qs[1:3]], ["Japan", "Germany"])
+        self.assertEqual([c["name"] for c in qs.order_by("name")], ["China", "France", "Germany", "Iceland", "Japan"])
+
+    def test_union_slice_is_lazy(self):
+        qs = self.europe.union(self.asia).order_by("population")
+        results = iter(qs)
+        self.assertEqual([next(results)["name"], next(results)["name"]], ["Iceland", "France"])
+        # only the records needed for the merge have been consumed from each child
+        self.assertEqual([c["name"] for c in self.europe.consumed], ["Iceland", "France"])
+        self.assertEqual([c["name"] for c in self.asia.consumed], ["Japan"])
+
+    def test_union_filter_and_count(self):
+        qs = self.europe.union(self.asia).filter(continent="asia")
+        self.assertEqual(qs.count(), 2)
+        self.assertEqual(qs[1:].count(), 1)
+        self.assertEqual([c["name"] for c in qs.order_by("population")], ["Japan", "China"])
+
+    def test_ordered_union_with_nulls(self):
+        qs = ListQuerySet([{"a": 1}, {"a": None}]).union(ListQuerySet([{"a": 2}])).order_by("a")
+        self.assertEqual(list(qs), [{"a": 1}, {"a": 2}, {"a": None}])
+        self.assertEqual(list(qs.order_by("-a")), [{"a": None}, {"a": 2}, {"a": 1}])
+
+    def test_ordered_union_with_mixed_values(self):
+        atlantis = ListQuerySet([
+            {"name": "Atlantis", "population": None, "continent": "europe"},
+            {"name": "Lemuria", "population": None, "continent": "asia"},
+        ])
+        qs = self.europe.union(atlantis, self.asia).order_by("population", "name")
+        self.assertEqual([c["name"] for c in qs], [
+            "Iceland", "France", "Germany", "Japan", "China", "Atlantis", "Lemuria",
+        ])
+        self.assertEqual([c["name"] for c in qs.order_by("-population", "name")[:3]], [
+            "Atlantis", "Lemuria", "China",
+        ])
+
+
+class TestSpillingResults(TestCase):
+    def test_results_are_spilled_to_disk(self):
+        qs = CounterQuerySet()
+        qs.max_results_in_memory = 3
+        self.assertEqual(list(qs), list(range(0, 10)))
+        self.assertEqual(qs._results.spilled_count, 7)
+        self.assertEqual(len(qs), 10)
+        self.assertEqual(qs[8], 8)
+        self.assertEqual(list(qs[2:5]), [2, 3, 4])
+        self.assertEqual(list(qs), list(range(0, 10)))
+        self.assertEqual(qs.run_query_call_count, 1)
+
+        # slices of the results read spilled items as they are accessed
+        with mock.patch.object(SpillingResultList, "_get_spilled", wraps=qs._results._get_spilled) as get_spilled:
+            sliced = qs[2:9]
+            self.assertEqual(get_spilled.call_count, 0)
+            self.assertEqual(sliced[4], 6)
+            self.assertEqual(list(sliced[1:3]), [3, 4])
+            self.assertEqual(get_spilled.call_count, 3)
+            self.assertEqual(list(sliced), list(range(2, 9)))
+            self.assertEqual(sliced[-1], 8)
+            self.assertEqual(pickle.loads(pickle.dumps(sliced))._results, list(range(2, 9)))
+
+        spill_file = qs._results._spill_file
+        del qs, sliced, get_spilled
+        gc.collect()
+        self.assertTrue(spill_file.file.closed)
+
+
+class TestRecordSet(TestCase):
+    def setUp(self):
+        self.record_set = RecordSet([
+            {"id": 1, "name": "Nova Scotia", "continent": "america"},
+            {"id": 2, "name": "Novara", "continent": "europe"},
+            {"id": 3, "name": "Villanova", "continent": "europe"},
+            {"id": 4, "name": "Nova", "continent": "europe"},
+            {"id": 5, "name": None, "continent": "europe"},
+        ])
+
+    def test_search(self):
+        results = self.record_set.query([("name__search", "nova")])
+        # exact word matches rank above prefix matches
+        self.assertEqual([r["id"] for r in results], [1, 4, 2])
+        results = self.record_set.query([("name__search", "NOV"), ("continent", "europe")])
+        self.assertEqual([r["id"] for r in results], [2, 4])
+        results = self.record_set.query([("name__search", "nov sco")])
+        self.assertEqual([r["id"] for r in results], [1])
+        results = self.record_set.query([("name__search", "nova")], ordering=["-id"], limit=2)
+        self.assertEqual([r["id"] for r in results], [4, 2])
+        self.assertEqual(self.record_set.count([("name__search", "nova")], offset=1), 2)
+        self.assertEqual(self.record_set.count([("name__search", "")]), 0)
+
+    def test_search_index_is_updated(self):
+        self.assertEqual(self.record_set.count([("name__search", "nova")]), 3)
+        new_record = {"id": 6, "name": "Terra Nova", "continent": "america"}
+        self.record_set.add(new_record)
+        self.assertEqual(self.record_set.count([("name__search", "nova")]), 4)
+        self.record_set.remove(new_record)
+        self.assertEqual(self.record_set.count([("name__search", "terra")]), 0)
+        self.assertNotIn("terra", self.record_set.get_search_index("name").terms)
+        self.assertEqual(len(self.record_set), 5)
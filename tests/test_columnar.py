@@ -0,0 +1,75 @@
+from unittest import SkipTest, TestCase, mock
+
+try:
+    import numpy  # noqa: F401
+except ImportError:
+    raise SkipTest("numpy is not installed")
+
+from queryish import VirtualModel
+from queryish.columnar import ColumnarQuerySet
+
+
+class Country(VirtualModel):
+    base_query_class = ColumnarQuerySet
+
+    class Meta:
+        fields = ["id", "name", "continent", "population", "landlocked"]
+        records = [
+            {"id": 1, "name": "France", "continent": "europe", "population": 68.0, "landlocked": False},
+            {"id": 2, "name": "Austria", "continent": "europe", "population": 9.1, "landlocked": True},
+            {"id": 3, "name": "Japan", "continent": "asia", "population": 124.5, "landlocked": False},
+            {"id": 4, "name": "Mongolia", "continent": "asia", "population": 3.4, "landlocked": True},
+            {"id": 5, "name": "Atlantis", "continent": None, "population": None, "landlocked": False},
+        ]
+
+
+class TestColumnarQuerySet(TestCase):
+    def test_filter(self):
+        self.assertEqual([c.name for c in Country.objects.filter(continent="asia")], ["Japan", "Mongolia"])
+        self.assertEqual(
+            [c.name for c in Country.objects.filter(name__startswith="A", landlocked=True)], ["Austria"]
+        )
+        self.assertEqual([c.id for c in Country.objects.filter(population__gt=10)], [1, 3])
+        self.assertEqual([c.id for c in Country.objects.filter(id__in=[2, 4, 6])], [2, 4])
+        self.assertEqual([c.id for c in Country.objects.filter(continent__isnull=True)], [5])
+        self.assertEqual([c.id for c in Country.objects.filter(population=None)], [5])
+        with self.assertRaises(ValueError):
+            Country.objects.filter(capital="Paris")
+
+    def test_pk_lookups(self):
+        self.assertEqual(Country.objects.get(pk=3).name, "Japan")
+        self.assertEqual([c.name for c in Country.objects.filter(pk__in=[1, 4])], ["France", "Mongolia"])
+        self.assertEqual(Country.objects.filter(pk__gt=3).count(), 2)
+
+    def test_ordering(self):
+        self.assertEqual(
+            [c.id for c in Country.objects.order_by("population")], [4, 2, 1, 3, 5]
+        )
+        # nulls come first in descending order, as with RecordSet
+        self.assertEqual(
+            [c.id for c in Country.objects.order_by("-continent", "name")], [5, 2, 1, 3, 4]
+        )
+        self.assertEqual([c.name for c in Country.objects.order_by("-population")[1:3]], ["Japan", "France"])
+        self.assertEqual(Country.objects.order_by("name").last().name, "Mongolia")
+
+    def test_count(self):
+        self.assertEqual(Country.objects.count(), 5)
+        self.assertEqual(Country.objects.filter(landlocked=False).count(), 3)
+        self.assertEqual(Country.objects.filter(landlocked=False)[1:].count(), 2)
+
+    def test_instances_built_lazily(self):
+        from_query_data = mock.Mock(wraps=Country.from_query_data)
+        with mock.patch.object(Country, "from_query_data", from_query_data):
+            self.assertEqual(Country.objects.order_by("name").first().name, "Atlantis")
+        self.assertEqual(from_query_data.call_count, 1)
+
+    def test_search(self):
+        self.assertEqual([c.name for c in Country.objects.filter(name__search="a")], ["Austria", "Atlantis"])
+        self.assertEqual(Country.objects.filter(name__search="mon", landlocked=True).count(), 1)
+        self.assertEqual(Country.objects.filter(name__search="").count(), 0)
+
+    def test_without_model(self):
+        class PlanetQuerySet(ColumnarQuerySet):
+            records = [{"name": "Mercury", "moons": 0}, {"name": "Mars", "moons": 2}]
+
+        self.assertEqual(list(PlanetQuerySet().filter(moons__gte=1)), [{"name": "Mars", "moons": 2}])
@@ -1,9 +1,26 @@
+import datetime
+import json
+import pickle
 import re
-from unittest import TestCase
+import time
+from concurrent.futures import ThreadPoolExecutor
+import threading
+from unittest import TestCase, mock, skipUnless
 import responses
 from responses import matchers
 
-from queryish.rest import APIModel, APIQuerySet
+from queryish import (
+    Avg, Count, Field, IdentityMap, Max, Min, ResultCache, Sum, cache_scope, gather,
+    get_current_scope,
+)
+from queryish.middleware import CacheScopeMiddleware
+from queryish.rest import APIModel, APIQuerySet, fetch_batched
+from queryish.warming import CacheWarmer
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 
 class CountryAPIQuerySet(APIQuerySet):
@@ -16,15 +33,50 @@ class UnpaginatedCountryAPIQuerySet(CountryAPIQuerySet):
     pass
 
 
+class ClientSideFilteredCountryAPIQuerySet(CountryAPIQuerySet):
+    client_side_filtering = True
+
+
 class LimitOffsetPaginatedCountryAPIQuerySet(CountryAPIQuerySet):
     pagination_style = "offset-limit"
 
 
+class BlockPaginatedCountryAPIQuerySet(LimitOffsetPaginatedCountryAPIQuerySet):
+    block_size = 2
+
+
+class KeysetPaginatedCountryAPIQuerySet(LimitOffsetPaginatedCountryAPIQuerySet):
+    keyset_pagination = True
+
+
 class PageNumberPaginatedCountryAPIQuerySet(CountryAPIQuerySet):
     pagination_style = "page-number"
     page_size = 2
 
 
+class ConcurrentPageNumberPaginatedCountryAPIQuerySet(PageNumberPaginatedCountryAPIQuerySet):
+    max_concurrent_requests = 2
+
+
+class BatchedCountryAPIQuerySet(PageNumberPaginatedCountryAPIQuerySet):
+    batch_url = "http://example.com/api/batch/"
+
+
+class BatchedContinentAPIQuerySet(APIQuerySet):
+    base_url = "http://example.com/api/continents/"
+    batch_url = "http://example.com/api/batch/"
+
+
+class ReadaheadCountryAPIQuerySet(LimitOffsetPaginatedCountryAPIQuerySet):
+    readahead = True
+    readahead_previous = True
+
+
+class SparseFieldsetCountryAPIQuerySet(CountryAPIQuerySet):
+    fields_query_param = "fields"
+    omit_query_param = "omit"
+
+
 class Country(APIModel):
     class Meta:
         base_url = "http://example.com/api/countries/"
@@ -34,6 +86,80 @@ class Country(APIModel):
         return self.name
 
 
+class CachedCountry(APIModel):
+    class Meta:
+        base_url = "http://example.com/api/countries/"
+        fields = ["id", "name", "continent"]
+        result_cache = ResultCache(timeout=60)
+        result_cache_as_rows = True
+
+
+class CachedCity(APIModel):
+    class Meta:
+        base_url = "http://example.com/api/cities/"
+        fields = ["id", "name", "continent"]
+        # shares a result cache with CachedCountry
+        result_cache = CachedCountry.objects.result_cache
+        result_cache_as_rows = True
+
+
+class WarmedCountry(APIModel):
+    class Meta:
+        base_url = "http://example.com/api/countries/"
+        fields = ["id", "name", "continent"]
+        result_cache = ResultCache(timeout=60)
+        warm_queries = [
+            lambda countries: countries.filter(continent="asia"),
+        ]
+
+
+class Party(APIModel):
+    class Meta:
+        base_url = "http://example.com/api/parties/"
+        fields = [
+            "id",
+            Field("title", source="name"),
+            Field("start_date", converter=datetime.date.fromisoformat),
+            Field("country_code", source="location.country", default="ZZ"),
+        ]
+
+
+class LabelledParty(Party):
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.label = "%s (%s)" % (self.title, self.country_code)
+
+
+class SparseFieldsetParty(APIModel):
+    class Meta:
+        base_url = "http://example.com/api/parties/"
+        fields = ["id", Field("title", source="name"), "start_date"]
+        fields_query_param = "fields"
+        omit_query_param = "omit"
+
+
+class MappedCountry(APIModel):
+    class Meta:
+        base_url = "http://example.com/api/countries/"
+        detail_url = "http://example.com/api/countries/%d/"
+        fields = ["id", "name", "continent"]
+        identity_map = IdentityMap(max_size=100)
+
+
+class BulkCountry(APIModel):
+    class Meta:
+        base_url = "http://example.com/api/countries/"
+        fields = ["id", "name", "continent"]
+        in_bulk_query_param = "id__in"
+
+
+class City(APIModel):
+    class Meta:
+        base_url = "http://example.com/api/cities/"
+        fields = ["id", "name", "country_id"]
+        relations = {"country": ("country_id", BulkCountry)}
+
+
 class Pokemon(APIModel):
     class Meta:
         base_url = "https://pokeapi.co/api/v2/pokemon/"
@@ -227,6 +353,355 @@ class TestAPIQuerySet(TestCase):
             {"id": 4, "name": "Japan", "continent": "asia"},
         ])
 
+    @responses.activate
+    def test_fetch_block_paginated(self):
+        countries = [
+            {"id": 1, "name": "France", "continent": "europe"},
+            {"id": 2, "name": "Germany", "continent": "europe"},
+            {"id": 3, "name": "Italy", "continent": "europe"},
+            {"id": 4, "name": "Japan", "continent": "asia"},
+            {"id": 5, "name": "China", "continent": "asia"},
+        ]
+        for offset in (0, 2, 4):
+            responses.add(
+                responses.GET, "http://example.com/api/countries/",
+                match=[matchers.query_param_matcher({"offset": offset, "limit": 2})],
+                json={"count": 5, "results": countries[offset:offset + 2]},
+            )
+
+        qs = BlockPaginatedCountryAPIQuerySet()
+        self.assertEqual(qs[1:3].count(), 2)
+        self.assertEqual([result["id"] for result in qs[1:3]], [2, 3])
+        self.assertEqual(len(responses.calls), 2)
+        # overlapping slices are assembled from the blocks already fetched
+        self.assertEqual([result["id"] for result in qs[0:4]], [1, 2, 3, 4])
+        self.assertEqual([result["id"] for result in qs[3:]], [4, 5])
+        self.assertEqual(len(responses.calls), 3)
+
+    @responses.activate
+    def test_block_larger_than_api_limit(self):
+        # the API returns at most 3 results per request, regardless of the limit requested
+        self.add_numbered_countries_callback(10, max_limit=3)
+
+        class LargeBlockCountryAPIQuerySet(LimitOffsetPaginatedCountryAPIQuerySet):
+            block_size = 5
+
+        class ConcurrentLargeBlockCountryAPIQuerySet(LargeBlockCountryAPIQuerySet):
+            max_concurrent_requests = 2
+
+        qs = LargeBlockCountryAPIQuerySet()
+        self.assertEqual([result["id"] for result in qs], list(range(10)))
+        self.assertEqual(qs.count(), 10)
+        self.assertEqual([result["id"] for result in LargeBlockCountryAPIQuerySet()[4:9]], [4, 5, 6, 7, 8])
+        self.assertEqual(
+            [result["id"] for result in ConcurrentLargeBlockCountryAPIQuerySet()], list(range(10))
+        )
+
+    @responses.activate
+    def test_explain(self):
+        countries = [
+            {"id": 1, "name": "France", "continent": "europe"},
+            {"id": 2, "name": "Germany", "continent": "europe"},
+            {"id": 3, "name": "Italy", "continent": "europe"},
+            {"id": 4, "name": "Japan", "continent": "asia"},
+            {"id": 5, "name": "China", "continent": "asia"},
+        ]
+        for page in (1, 2, 3):
+            responses.add(
+                responses.GET, "http://example.com/api/countries/",
+                match=[matchers.query_param_matcher({"page": page})],
+                json={"count": 5, "results": countries[page * 2 - 2:page * 2]},
+            )
+
+        qs = PageNumberPaginatedCountryAPIQuerySet()
+        plan = qs[1:4].explain()
+        self.assertEqual(plan["requests"], [
+            {"url": "http://example.com/api/countries/", "params": {"page": 1}, "cached": False},
+            {"url": "http://example.com/api/countries/", "params": {"page": 2}, "cached": False},
+        ])
+        self.assertEqual(plan["estimated_requests"], 2)
+        self.assertTrue(plan["complete"])
+
+        # the number of pages in an unsliced queryset is not known until the count is
+        plan = qs.explain()
+        self.assertEqual(len(plan["requests"]), 1)
+        self.assertFalse(plan["complete"])
+        self.assertEqual(len(responses.calls), 0)
+
+        self.assertEqual(qs.count(), 5)
+        self.assertEqual(len(responses.calls), 1)
+        plan = qs.explain()
+        self.assertEqual([request["params"] for request in plan["requests"]], [
+            {"page": 1}, {"page": 2}, {"page": 3},
+        ])
+        self.assertEqual(plan["cache_hits"], 1)
+        self.assertEqual(plan["estimated_requests"], 2)
+        self.assertTrue(plan["complete"])
+
+        self.assertEqual(qs.explain(count=True)["requests"], [])
+        plan = qs.clone().explain(count=True)
+        self.assertEqual(plan["cache_hits"], 1)
+        self.assertEqual(plan["estimated_requests"], 0)
+
+        list(qs)
+        self.assertEqual(len(responses.calls), 3)
+        self.assertEqual(qs.explain()["requests"], [])
+
+        plan = LimitOffsetPaginatedCountryAPIQuerySet().filter(name="France")[:10].explain()
+        self.assertEqual(plan["requests"], [{
+            "url": "http://example.com/api/countries/",
+            "params": {"name": "France", "offset": 0, "limit": 10},
+            "cached": False,
+        }])
+
+        plan = MappedCountry.objects.filter(id=1).explain()
+        self.assertEqual(plan["requests"][0]["url"], "http://example.com/api/countries/1/")
+
+    @responses.activate
+    def test_export(self):
+        countries = [
+            {"id": 1, "name": "France", "continent": "europe"},
+            {"id": 2, "name": "Germany", "continent": "europe"},
+            {"id": 3, "name": "Italy", "continent": "europe"},
+            {"id": 4, "name": "Japan", "continent": "asia"},
+            {"id": 5, "name": "China", "continent": "asia"},
+        ]
+        for page in (1, 2, 3):
+            responses.add(
+                responses.GET, "http://example.com/api/countries/",
+                match=[matchers.query_param_matcher({"page": page})],
+                json={"count": 5, "results": countries[page * 2 - 2:page * 2]},
+            )
+
+        qs = PageNumberPaginatedCountryAPIQuerySet()
+        self.assertEqual(list(qs.export(processes=2)), countries)
+        self.assertEqual(
+            list(qs[1:4].export(fields=["name"], processes=2)),
+            [{"name": "Germany"}, {"name": "Italy"}, {"name": "Japan"}],
+        )
+        # exported responses are not cached
+        self.assertEqual(len(responses.calls), 5)
+        self.assertEqual(qs._responses, {})
+
+    @responses.activate
+    def test_export_unpaginated(self):
+        responses.add(
+            responses.GET, "http://example.com/api/countries/",
+            json=[
+                {"id": 1, "name": "France", "continent": "europe"},
+                {"id": 2, "name": "Germany", "continent": "europe"},
+            ],
+        )
+        self.assertEqual([country.name for country in Country.objects.export()], ["France", "Germany"])
+
+    @responses.activate
+    def test_export_detail_lookup(self):
+        responses.add(
+            responses.GET, "https://pokeapi.co/api/v2/pokemon/3/",
+            json={"name": "venusaur", "id": 3},
+        )
+        # the detail record is built with from_individual_data, as for get()
+        results = list(Pokemon.objects.filter(id=3).export())
+        self.assertEqual([(pokemon.id, pokemon.name) for pokemon in results], [(3, "venusaur")])
+        self.assertEqual(list(Pokemon.objects.filter(id=3).export(fields=["name"])), [{"name": "venusaur"}])
+
+    @responses.activate
+    def test_fetch_batched(self):
+        countries = [
+            {"id": 1, "name": "France", "continent": "europe"},
+            {"id": 2, "name": "Germany", "continent": "europe"},
+            {"id": 3, "name": "Italy", "continent": "europe"},
+            {"id": 4, "name": "Japan", "continent": "asia"},
+            {"id": 5, "name": "China", "continent": "asia"},
+        ]
+        continents = [{"id": "asia"}, {"id": "europe"}]
+
+        def batch_callback(request):
+            batch_responses = []
+            for item in json.loads(request.body)["requests"]:
+                if item["url"] == "http://example.com/api/continents/":
+                    body = continents
+                else:
+                    page = item["params"]["page"]
+                    body = {"count": 5, "results": countries[page * 2 - 2:page * 2]}
+                batch_responses.append({"status": 200, "body": body})
+            return (200, {}, json.dumps({"responses": batch_responses}))
+
+        responses.add_callback(
+            responses.POST, "http://example.com/api/batch/", callback=batch_callback,
+        )
+
+        country_qs = BatchedCountryAPIQuerySet()
+        continent_qs = BatchedContinentAPIQuerySet()
+        fetch_batched(country_qs, country_qs[1:2].count, continent_qs)
+        # the first round fetches the first page of countries, along with the continents;
+        # the second fetches the remaining pages, now that the count is known
+        self.assertEqual(len(responses.calls), 2)
+        self.assertEqual(
+            [len(json.loads(call.request.body)["requests"]) for call in responses.calls], [2, 2]
+        )
+
+        self.assertEqual([country["name"] for country in country_qs], [c["name"] for c in countries])
+        self.assertEqual(country_qs[1:2].count(), 1)
+        self.assertEqual(list(continent_qs), continents)
+        self.assertEqual(len(responses.calls), 2)
+
+        with self.assertRaises(TypeError):
+            fetch_batched(country_qs.first)
+
+    def add_numbered_countries_callback(self, count, max_limit=None):
+        def callback(request):
+            offset = int(request.params["offset"])
+            limit = int(request.params["limit"])
+            if max_limit is not None:
+                limit = min(limit, max_limit)
+            return (200, {}, json.dumps({
+                "count": count,
+                "results": [
+                    {"id": i, "name": "Country %d" % i}
+                    for i in range(offset, min(offset + limit, count))
+                ],
+            }))
+
+        responses.add_callback(responses.GET, "http://example.com/api/countries/", callback=callback)
+
+    def wait_for_calls(self, count):
+        deadline = time.monotonic() + 5
+        while len(responses.calls) < count and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+    @responses.activate
+    def test_readahead(self):
+        self.add_numbered_countries_callback(50)
+        qs = ReadaheadCountryAPIQuerySet()
+        self.assertEqual([c["id"] for c in qs[20:30]], list(range(20, 30)))
+        # the following and preceding slices are fetched in the background
+        self.wait_for_calls(3)
+        self.assertEqual(
+            sorted(call.request.params["offset"] for call in responses.calls), ["10", "20", "30"]
+        )
+        self.assertEqual([c["id"] for c in qs[30:40]], list(range(30, 40)))
+        self.wait_for_calls(4)
+        self.assertEqual([c["id"] for c in qs[10:20]], list(range(10, 20)))
+        self.wait_for_calls(5)
+        self.assertEqual(len(responses.calls), 5)
+
+        # no readahead once the end of the results is reached
+        self.assertEqual(len(qs[45:55]), 5)
+        time.sleep(0.05)
+        self.assertEqual(
+            [call.request.params["offset"] for call in responses.calls[5:]], ["45"]
+        )
+
+    @responses.activate
+    def test_readahead_in_cache_scope(self):
+        class SparseReadaheadCountryAPIQuerySet(ReadaheadCountryAPIQuerySet):
+            fields_query_param = "fields"
+
+        self.add_numbered_countries_callback(50)
+        with cache_scope() as scope:
+            qs = SparseReadaheadCountryAPIQuerySet().only("name")
+            self.assertEqual([c["id"] for c in qs[0:10]], list(range(0, 10)))
+            self.wait_for_calls(2)
+            # the readahead response is stored in the scope, under the key of the request
+            # it stands in for, including the sparse fieldset parameter
+            self.assertEqual([c["id"] for c in qs[10:20]], list(range(10, 20)))
+            self.wait_for_calls(3)
+            self.assertIn(
+                qs.get_response_cache_key(qs.base_url, {"fields": "id,name", "offset": 10, "limit": 10}),
+                scope.responses,
+            )
+            self.assertEqual(qs._responses, {})
+        self.assertEqual(
+            sorted(call.request.params["offset"] for call in responses.calls), ["0", "10", "20"]
+        )
+        self.assertTrue(all(call.request.params["fields"] == "id,name" for call in responses.calls))
+
+    @responses.activate
+    def test_readahead_cancelled_at_end_of_cache_scope(self):
+        self.add_numbered_countries_callback(100)
+        executor = ThreadPoolExecutor(max_workers=1)
+        blocker = threading.Event()
+        executor.submit(blocker.wait)
+        qs = ReadaheadCountryAPIQuerySet()
+        with mock.patch("queryish.rest.get_readahead_executor", return_value=executor):
+            with cache_scope() as scope:
+                list(qs[20:30])
+                futures = [future for query, future in qs._readahead_futures.values()]
+                self.assertEqual(len(futures), 2)
+                self.assertEqual(scope.readahead_futures, set(futures))
+        # the readahead for the slices either side had not started, and is cancelled
+        self.assertTrue(all(future.cancelled() for future in futures))
+        self.assertEqual(scope.readahead_futures, set())
+        blocker.set()
+        executor.shutdown()
+        self.assertEqual(len(responses.calls), 1)
+        self.assertEqual(scope.responses, {})
+
+    @responses.activate
+    def test_readahead_cancellation(self):
+        self.add_numbered_countries_callback(100)
+        executor = ThreadPoolExecutor(max_workers=1)
+        blocker = threading.Event()
+        executor.submit(blocker.wait)
+        qs = ReadaheadCountryAPIQuerySet()
+        with mock.patch("queryish.rest.get_readahead_executor", return_value=executor):
+            list(qs[0:10])
+            [(query, future)] = qs._readahead_futures.values()
+            # moving to another slice supersedes the readahead that has not started yet
+            list(qs[50:60])
+            self.assertTrue(future.cancelled())
+            self.assertEqual(len(qs._readahead_futures), 2)
+        blocker.set()
+        executor.shutdown()
+        self.assertEqual(len(responses.calls), 4)
+        self.assertEqual(qs._readahead_futures, {})
+
+    @responses.activate
+    def test_fetch_keyset_paginated(self):
+        countries = [
+            {"id": 1, "name": "France", "continent": "europe"},
+            {"id": 2, "name": "Germany", "continent": "europe"},
+            {"id": 3, "name": "Italy", "continent": "europe"},
+            {"id": 4, "name": "Japan", "continent": "asia"},
+            {"id": 5, "name": "China", "continent": "asia"},
+        ]
+        responses.add(
+            responses.GET, "http://example.com/api/countries/",
+            match=[matchers.query_param_matcher({"ordering": "id", "offset": 0, "limit": 2})],
+            json={"count": 5, "results": countries[0:2]},
+        )
+        responses.add(
+            responses.GET, "http://example.com/api/countries/",
+            match=[matchers.query_param_matcher({"ordering": "id", "id__gt": 2, "offset": 0, "limit": 2})],
+            json={"count": 3, "results": countries[2:4]},
+        )
+        responses.add(
+            responses.GET, "http://example.com/api/countries/",
+            match=[matchers.query_param_matcher({"ordering": "id", "id__gt": 2, "offset": 1})],
+            json={"count": 3, "results": countries[3:5]},
+        )
+        responses.add(
+            responses.GET, "http://example.com/api/countries/",
+            match=[matchers.query_param_matcher({"ordering": "-id", "id__lt": 4, "offset": 0})],
+            json={"count": 3, "results": countries[2::-1]},
+        )
+        responses.add(
+            responses.GET, "http://example.com/api/countries/",
+            match=[matchers.query_param_matcher({"ordering": "-id", "offset": 0, "limit": 2})],
+            json={"count": 5, "results": countries[:2:-1]},
+        )
+
+        qs = KeysetPaginatedCountryAPIQuerySet().order_by("id")
+        self.assertEqual([result["id"] for result in qs[0:2]], [1, 2])
+        # later pages are requested relative to the last known key
+        self.assertEqual([result["id"] for result in qs[2:4]], [3, 4])
+        self.assertEqual([result["id"] for result in qs[3:]], [4, 5])
+
+        qs = KeysetPaginatedCountryAPIQuerySet().order_by("-id")
+        self.assertEqual([result["id"] for result in qs[:2]], [5, 4])
+        self.assertEqual([result["id"] for result in qs[2:]], [3, 2, 1])
+
     @responses.activate
     def test_fetch_page_number_paginated(self):
         responses.add(
@@ -305,6 +780,13 @@ class TestAPIQuerySet(TestCase):
             {"id": 4, "name": "Japan", "continent": "asia"},
         ])
 
+        # slices that start part-way through a page
+        partial_results = list(PageNumberPaginatedCountryAPIQuerySet()[1:4])
+        self.assertEqual([result["id"] for result in partial_results], [2, 3, 4])
+
+        concurrent_results = list(ConcurrentPageNumberPaginatedCountryAPIQuerySet()[1:])
+        self.assertEqual([result["id"] for result in concurrent_results], [2, 3, 4, 5])
+
     @responses.activate
     def test_filter(self):
         responses.add(
@@ -444,6 +926,36 @@ class TestAPIQuerySet(TestCase):
             {"id": 4, "name": "Japan", "continent": "asia"},
         ])
 
+    @responses.activate
+    def test_client_side_filtering(self):
+        responses.add(
+            responses.GET, "http://example.com/api/countries/",
+            match=[matchers.query_param_matcher({})],
+            json=[
+                {"id": 1, "name": "France", "continent": "europe"},
+                {"id": 2, "name": "Germany", "continent": "europe"},
+                {"id": 3, "name": "Italy", "continent": "europe"},
+                {"id": 4, "name": "Japan", "continent": "asia"},
+                {"id": 5, "name": "China", "continent": "asia"},
+            ],
+        )
+
+        qs = ClientSideFilteredCountryAPIQuerySet()
+        self.assertEqual(qs.filter(continent="europe").count(), 3)
+        self.assertEqual(
+            [c["name"] for c in qs.filter(continent="europe").order_by("-name")[:2]],
+            ["Italy", "Germany"],
+        )
+        self.assertEqual(
+            [c["name"] for c in qs.filter(name__icontains="an").order_by("continent", "name")],
+            ["Japan", "France", "Germany"],
+        )
+        self.assertEqual(qs.get(pk=5)["name"], "China")
+        self.assertEqual(qs.filter(id__in=[1, 4])[1:].count(), 1)
+        self.assertEqual([c["id"] for c in qs.filter(pk__in=[1, 4])], [1, 4])
+        self.assertEqual([c["id"] for c in qs.filter(pk__gt=3)], [4, 5])
+        self.assertEqual(len(responses.calls), 1)
+
     @responses.activate
     def test_get(self):
         responses.add(
@@ -502,6 +1014,347 @@ class TestAPIQuerySet(TestCase):
         with self.assertRaises(ValueError):
             UnpaginatedCountryAPIQuerySet().get(continent="europe")
 
+    @responses.activate
+    def test_only(self):
+        responses.add(
+            responses.GET, "http://example.com/api/countries/",
+            match=[matchers.query_param_matcher({"continent": "asia", "fields": "id,name"})],
+            body="""
+                [
+                    {
+                        "id": 4,
+                        "name": "Japan"
+                    },
+                    {
+                        "id": 5,
+                        "name": "China",
+                        "continent": "asia"
+                    }
+                ]
+            """
+        )
+
+        results = SparseFieldsetCountryAPIQuerySet().filter(continent="asia").only("name")
+        # fields not requested are stripped even if the API returns them
+        self.assertEqual(list(results), [
+            {"id": 4, "name": "Japan"},
+            {"id": 5, "name": "China"},
+        ])
+
+    @responses.activate
+    def test_defer(self):
+        responses.add(
+            responses.GET, "http://example.com/api/countries/",
+            match=[matchers.query_param_matcher({"omit": "continent"})],
+            body="""
+                [
+                    {
+                        "id": 4,
+                        "name": "Japan"
+                    }
+                ]
+            """
+        )
+
+        results = SparseFieldsetCountryAPIQuerySet().defer("continent")
+        self.assertEqual(list(results), [{"id": 4, "name": "Japan"}])
+        # only() after defer() replaces the deferred fields
+        results = results.only("name")
+        self.assertEqual(results.deferred_fields, ())
+        self.assertEqual(results.only_fields, ("name",))
+
+    @responses.activate
+    def test_projection_with_field_sources(self):
+        responses.add(
+            responses.GET, "http://example.com/api/parties/",
+            match=[matchers.query_param_matcher({"fields": "id,name"})],
+            json=[{"id": 1, "name": "Revision", "start_date": "2023-04-07"}],
+        )
+        responses.add(
+            responses.GET, "http://example.com/api/parties/",
+            match=[matchers.query_param_matcher({"omit": "name"})],
+            json=[{"id": 1, "name": "Revision", "start_date": "2023-04-07"}],
+        )
+
+        # only() and defer() refer to model fields, and are sent as the keys they are read from
+        party = list(SparseFieldsetParty.objects.only("title"))[0]
+        self.assertEqual((party.pk, party.title, party.start_date), (1, "Revision", None))
+
+        party = list(SparseFieldsetParty.objects.defer("title"))[0]
+        self.assertEqual((party.pk, party.title, party.start_date), (1, None, "2023-04-07"))
+
+
+class TestCacheScope(TestCase):
+    def setUp(self):
+        responses.add(
+            responses.GET, "http://example.com/api/countries/",
+            json=[
+                {"id": 1, "name": "France", "continent": "europe"},
+                {"id": 2, "name": "Germany", "continent": "europe"},
+            ],
+        )
+
+    @responses.activate
+    def test_cache_scope(self):
+        with cache_scope():
+            self.assertEqual(len(CountryAPIQuerySet()), 2)
+            # separate queryset instances share the scope's responses
+            self.assertEqual(len(CountryAPIQuerySet()), 2)
+            self.assertEqual(len(responses.calls), 1)
+            # as do querysets evaluated on other threads
+            qs, count = gather(CountryAPIQuerySet(), CountryAPIQuerySet().count)
+            self.assertEqual(count, 2)
+            self.assertEqual(len(responses.calls), 1)
+
+        self.assertIsNone(get_current_scope())
+        self.assertEqual(len(CountryAPIQuerySet()), 2)
+        self.assertEqual(len(responses.calls), 2)
+
+    @responses.activate
+    def test_identity_map_in_cache_scope(self):
+        with cache_scope() as scope:
+            france = Country.objects.first()
+            self.assertIs(Country.objects.get(id=1), france)
+            self.assertEqual(len(responses.calls), 1)
+            # identity maps are kept separate for each model
+            self.assertIsInstance(CachedCountry.objects.first(), CachedCountry)
+            self.assertEqual(len(scope.identity_maps), 2)
+        self.assertEqual(scope.identity_maps, {})
+
+    @responses.activate
+    def test_middleware(self):
+        def get_response(request):
+            self.assertIsNotNone(get_current_scope())
+            return [country["name"] for country in CountryAPIQuerySet()]
+
+        middleware = CacheScopeMiddleware(get_response)
+        self.assertEqual(middleware(None), ["France", "Germany"])
+        self.assertIsNone(get_current_scope())
+
+
+class TestCacheWarmer(TestCase):
+    def add_response(self, names):
+        responses.add(
+            responses.GET, "http://example.com/api/countries/",
+            match=[matchers.query_param_matcher({"continent": "asia"})],
+            json=[{"id": i, "name": name, "continent": "asia"} for i, name in enumerate(names)],
+        )
+
+    @responses.activate
+    def test_refresh(self):
+        self.add_response(["Japan"])
+        qs = CountryAPIQuerySet().filter(continent="asia")
+        self.assertEqual([c["name"] for c in qs], ["Japan"])
+
+        responses.reset()
+        self.add_response(["Japan", "China"])
+        refreshed = qs.refresh()
+        self.assertEqual(len(refreshed), 2)
+        # the response cache shared with the original queryset is updated
+        self.assertEqual([c["name"] for c in qs.clone()], ["Japan", "China"])
+        self.assertEqual(len(responses.calls), 1)
+
+    @responses.activate
+    def test_warm_queries(self):
+        self.add_response(["Japan"])
+        warmer = CacheWarmer()
+        [query] = warmer.register_model(WarmedCountry)
+        self.assertEqual(query.interval, 48)
+        warmer.refresh_all()
+        # served from the result cache, without using the warmed queryset's responses
+        qs = WarmedCountry.query_class().filter(continent="asia")
+        self.assertEqual([country.name for country in qs], ["Japan"])
+        self.assertEqual(len(responses.calls), 1)
+
+        responses.reset()
+        with self.assertLogs("queryish.warming", level="ERROR"):
+            warmer.refresh_all()
+        [metrics] = warmer.get_metrics()
+        self.assertEqual(metrics["refreshes"], 1)
+        self.assertEqual(metrics["failures"], 1)
+        self.assertIn("ConnectionError", metrics["last_error"])
+
+    @responses.activate
+    def test_background_refresh(self):
+        self.add_response(["Japan"])
+        warmer = CacheWarmer(max_concurrent_per_host=1)
+        query = warmer.register(CountryAPIQuerySet().filter(continent="asia"), interval=0.05)
+        warmer.start()
+        try:
+            deadline = time.monotonic() + 5
+            while query.refreshes < 2 and time.monotonic() < deadline:
+                time.sleep(0.01)
+        finally:
+            warmer.stop()
+        self.assertGreaterEqual(query.refreshes, 2)
+        self.assertEqual(query.failures, 0)
+        self.assertIsNotNone(query.last_refresh)
+
+    @responses.activate
+    def test_restart_without_waiting(self):
+        self.add_response(["Japan"])
+        warmer = CacheWarmer()
+        query = warmer.register(CountryAPIQuerySet().filter(continent="asia"), interval=0.01)
+        with mock.patch("threading.excepthook") as excepthook:
+            warmer.start()
+            old_thread = warmer._thread
+            warmer.stop(wait=False)
+            warmer.start()
+            try:
+                # the old thread exits by itself, leaving only the new one scheduling
+                old_thread.join(timeout=5)
+                self.assertFalse(old_thread.is_alive())
+                self.assertTrue(warmer._thread.is_alive())
+                refreshes = query.refreshes
+                deadline = time.monotonic() + 5
+                while query.refreshes < refreshes + 2 and time.monotonic() < deadline:
+                    time.sleep(0.01)
+            finally:
+                warmer.stop()
+        self.assertGreaterEqual(query.refreshes, refreshes + 2)
+        excepthook.assert_not_called()
+
+
+class TestAggregates(TestCase):
+    def setUp(self):
+        for page, results in enumerate([
+            [{"id": 1, "population": 68}, {"id": 2, "population": 84}],
+            [{"id": 3, "population": 59}, {"id": 4, "population": 125}],
+            [{"id": 5, "population": None}],
+        ], start=1):
+            responses.add(
+                responses.GET, "http://example.com/api/countries/",
+                match=[matchers.query_param_matcher({"page": page})],
+                json={"count": 5, "results": results},
+            )
+
+    @responses.activate
+    def test_aggregate(self):
+        qs = PageNumberPaginatedCountryAPIQuerySet()
+        result = qs.aggregate(Count("population"), Sum("population"), Avg("population"), total=Count())
+        self.assertEqual(result, {
+            "population__count": 4,
+            "population__sum": 336,
+            "population__avg": 84,
+            "total": 5,
+        })
+        # aggregates are computed without populating the response cache
+        self.assertEqual(qs._responses, {})
+
+        result = qs[1:3].aggregate(Min("population"), Max("population"))
+        self.assertEqual(result, {"population__min": 59, "population__max": 84})
+
+    @responses.activate
+    def test_aggregate_concurrent(self):
+        qs = ConcurrentPageNumberPaginatedCountryAPIQuerySet()
+        self.assertEqual(qs.aggregate(Sum("population")), {"population__sum": 336})
+        self.assertEqual(len(responses.calls), 3)
+
+    @responses.activate
+    def test_count_aggregate_uses_count(self):
+        self.assertEqual(PageNumberPaginatedCountryAPIQuerySet().aggregate(total=Count()), {"total": 5})
+        self.assertEqual(len(responses.calls), 1)
+
+    @skipUnless(np, "numpy is not installed")
+    @responses.activate
+    def test_to_columns(self):
+        qs = PageNumberPaginatedCountryAPIQuerySet()[1:]
+        columns = qs.to_columns(["id", "population"])
+        self.assertEqual(columns["id"].dtype, np.int64)
+        self.assertEqual(columns["id"].tolist(), [2, 3, 4, 5])
+        # the column is widened to hold the null in the last page
+        self.assertEqual(columns["population"].dtype, object)
+        self.assertEqual(columns["population"].tolist(), [84, 59, 125, None])
+        self.assertEqual(qs._responses, {})
+
+    @skipUnless(np, "numpy is not installed")
+    @responses.activate
+    def test_to_numpy(self):
+        array = PageNumberPaginatedCountryAPIQuerySet()[:4].to_numpy(
+            ["id", "population"], dtypes={"id": np.int64, "population": np.float64}
+        )
+        self.assertEqual(array.dtype.names, ("id", "population"))
+        self.assertEqual(array["id"].tolist(), [1, 2, 3, 4])
+        self.assertEqual(array["population"].sum(), 336)
+
+    @skipUnless(np, "numpy is not installed")
+    @responses.activate
+    def test_to_numpy_allocates_from_count(self):
+        qs = PageNumberPaginatedCountryAPIQuerySet()[:4]
+        with mock.patch("numpy.resize", wraps=np.resize) as resize:
+            array = qs.to_numpy(["id", "population", "name"])
+        # the array is sized from the count in the first response, without resizing
+        resize.assert_not_called()
+        self.assertEqual(len(responses.calls), 2)
+        self.assertEqual(qs.count(), 4)
+        self.assertEqual(len(responses.calls), 2)
+        self.assertEqual(
+            [array.dtype[field] for field in ("id", "population", "name")],
+            [np.int64, np.int64, object],
+        )
+        self.assertEqual(array["population"].sum(), 336)
+
+    @skipUnless(np, "numpy is not installed")
+    @responses.activate
+    def test_to_numpy_unpaginated(self):
+        responses.add(
+            responses.GET, "http://example.com/api/countries/",
+            json=[
+                {"id": 1, "name": "France", "continent": "europe"},
+                {"id": 4, "name": "Japan", "continent": "asia"},
+            ],
+        )
+        array = CountryAPIQuerySet().to_numpy(["id", "name"])
+        self.assertEqual(array["name"].tolist(), ["France", "Japan"])
+        # the size of the array is not found with a separate count() request
+        self.assertEqual(len(responses.calls), 1)
+
+    @responses.activate
+    def test_stream_record_pages(self):
+        qs = PageNumberPaginatedCountryAPIQuerySet()
+        self.assertEqual(
+            [[record["id"] for record in page] for page in qs.stream_record_pages(page_size=1)],
+            [[1], [2], [3], [4], [5]],
+        )
+        # evaluated results are reused
+        results = list(qs)
+        calls = len(responses.calls)
+        self.assertEqual(list(qs.stream_record_pages()), [results])
+        self.assertEqual(len(responses.calls), calls)
+
+    @responses.activate
+    def test_to_arrow(self):
+        table = PageNumberPaginatedCountryAPIQuerySet().to_arrow(["id", "population"])
+        self.assertEqual(table.num_rows, 5)
+        self.assertEqual(table.column("population").to_pylist(), [68, 84, 59, 125, None])
+
+    @responses.activate
+    def test_distinct_values(self):
+        responses.add(
+            responses.GET, "http://example.com/api/countries/",
+            json=[
+                {"id": 1, "name": "France", "continent": "europe"},
+                {"id": 4, "name": "Japan", "continent": "asia"},
+                {"id": 2, "name": "Germany", "continent": "europe"},
+            ],
+        )
+        self.assertEqual(UnpaginatedCountryAPIQuerySet().distinct_values("continent"), ["europe", "asia"])
+
+    @responses.activate
+    def test_upstream_aggregate(self):
+        class AggregatingCountryAPIQuerySet(CountryAPIQuerySet):
+            aggregate_query_param = "aggregate"
+
+        responses.add(
+            responses.GET, "http://example.com/api/countries/",
+            match=[matchers.query_param_matcher({
+                "continent": "asia", "aggregate": "population__sum:sum:population",
+            })],
+            json={"population__sum": 1551},
+        )
+        result = AggregatingCountryAPIQuerySet().filter(continent="asia").aggregate(Sum("population"))
+        self.assertEqual(result, {"population__sum": 1551})
+
 
 class TestAPIModel(TestCase):
     @responses.activate
@@ -584,3 +1437,203 @@ class TestAPIModel(TestCase):
         self.assertEqual(result[3].id, 3)
         self.assertEqual(result[6].name, "charizard")
         self.assertEqual(result[6].id, 6)
+
+    @responses.activate
+    def test_result_cache(self):
+        responses.add(
+            responses.GET, "http://example.com/api/countries/",
+            match=[matchers.query_param_matcher({"continent": "asia"})],
+            json=[
+                {"id": 4, "name": "Japan", "continent": "asia"},
+                {"id": 5, "name": "China", "continent": "asia"},
+            ],
+        )
+        results = list(CachedCountry.objects.filter(continent="asia"))
+        self.assertEqual(results[0].name, "Japan")
+        self.assertEqual(list(CachedCountry.objects.result_cache.get(
+            CachedCountry.objects.filter(continent="asia").get_result_cache_key()
+        )), [(4, "Japan", "asia"), (5, "China", "asia")])
+
+        # a fresh queryset with a separate response cache is served from the result cache
+        qs = CachedCountry.query_class().filter(continent="asia")
+        self.assertEqual([country.name for country in qs], ["Japan", "China"])
+        self.assertEqual(qs[1].pk, 5)
+        self.assertEqual(len(responses.calls), 1)
+
+        # counting cached rows does not build results from them
+        qs = CachedCountry.query_class().filter(continent="asia")
+        self.assertEqual(qs.count(), 2)
+        self.assertIsNone(qs._results)
+        self.assertEqual(len(responses.calls), 1)
+
+        CachedCountry.objects.invalidate_result_cache(continent="asia")
+        list(CachedCountry.query_class().filter(continent="asia"))
+        self.assertEqual(len(responses.calls), 2)
+
+    @responses.activate
+    def test_shared_result_cache(self):
+        responses.add(
+            responses.GET, "http://example.com/api/countries/",
+            json=[{"id": 1, "name": "France", "continent": "europe"}],
+        )
+        responses.add(
+            responses.GET, "http://example.com/api/cities/",
+            json=[{"id": 1, "name": "Paris", "continent": "europe"}],
+        )
+        # identical queries on models sharing a result cache are cached separately
+        self.assertEqual(CachedCountry.query_class().get(pk=1).name, "France")
+        self.assertEqual(CachedCity.query_class().get(pk=1).name, "Paris")
+        self.assertEqual(len(responses.calls), 2)
+
+    @responses.activate
+    def test_pickle(self):
+        responses.add(
+            responses.GET, "http://example.com/api/parties/",
+            json=[
+                {"id": 1, "name": "Revision", "start_date": "2023-04-07"},
+                {"id": 2, "name": "Assembly", "start_date": "2023-07-27", "location": {"country": "FI"}},
+            ],
+        )
+        qs = Party.objects.filter(title="Revision")
+        self.assertEqual(pickle.loads(pickle.dumps(qs)).query_key, qs.query_key)
+
+        qs = Party.objects.order_by("id")
+        results = list(qs)
+        data = pickle.dumps(qs)
+        # cached API responses are not included
+        self.assertNotIn(b"location", data)
+        restored = pickle.loads(data)
+        self.assertEqual(len(responses.calls), 1)
+        self.assertEqual(restored._responses, {})
+        self.assertEqual(restored.ordering, ("id",))
+        party = restored[1]
+        self.assertIsInstance(party, Party)
+        self.assertEqual(
+            (party.pk, party.title, party.start_date, party.country_code),
+            (2, "Assembly", datetime.date(2023, 7, 27), "FI"),
+        )
+        self.assertEqual(pickle.loads(pickle.dumps(results[0])).start_date, datetime.date(2023, 4, 7))
+
+    @responses.activate
+    def test_serialize(self):
+        responses.add(
+            responses.GET, "http://example.com/api/parties/",
+            json=[
+                {"id": 1, "name": "Revision", "start_date": "2023-04-07"},
+                {"id": 2, "name": "Assembly", "start_date": "2023-07-27", "location": {"country": "FI"}},
+            ],
+        )
+        data = Party.objects.order_by("-id")[:2].serialize()
+        self.assertEqual(data["fields"], ["id", "title", "start_date", "country_code"])
+        self.assertEqual(data["query"]["ordering"], ["-id"])
+        self.assertEqual(data["rows"][0], (1, "Revision", datetime.date(2023, 4, 7), "ZZ"))
+
+        qs = Party.query_class().deserialize(data)
+        self.assertEqual((qs.ordering, qs.offset, qs.limit), (("-id",), 0, 2))
+        self.assertEqual(qs.count(), 2)
+        self.assertEqual(qs._results._built, bytearray(2))
+        self.assertEqual(qs[1].title, "Assembly")
+        self.assertEqual([party.pk for party in qs], [1, 2])
+        self.assertEqual(len(responses.calls), 1)
+
+        with self.assertRaises(ValueError):
+            Country.objects.deserialize(data)
+
+    def test_field_declarations(self):
+        party = Party.from_query_data(
+            {"id": 1, "name": "Nova 2023", "start_date": "2023-06-23", "location": {"country": "GB"}}
+        )
+        self.assertEqual(party.pk, 1)
+        self.assertEqual(party.title, "Nova 2023")
+        self.assertEqual(party.start_date, datetime.date(2023, 6, 23))
+        self.assertEqual(party.country_code, "GB")
+
+        parties = Party.from_query_data_many([
+            {"id": 2, "name": "Revision 2023", "start_date": None, "location": None},
+            {"id": 3, "name": "Evoke 2023"},
+        ])
+        self.assertEqual([party.title for party in parties], ["Revision 2023", "Evoke 2023"])
+        self.assertIsNone(parties[0].start_date)
+        self.assertEqual(parties[1].country_code, "ZZ")
+
+    def test_field_declarations_with_custom_init(self):
+        parties = LabelledParty.from_query_data_many([
+            {"id": 1, "name": "Nova 2023", "location": {"country": "GB"}},
+        ])
+        self.assertEqual(parties[0].label, "Nova 2023 (GB)")
+        self.assertEqual(parties[0].pk, 1)
+
+    def test_from_query_data_many_uses_overridden_from_query_data(self):
+        results = Pokemon.from_query_data_many([
+            {"name": "bulbasaur", "url": "https://pokeapi.co/api/v2/pokemon/1/"},
+        ])
+        self.assertEqual(results[0].id, 1)
+
+    @responses.activate
+    def test_identity_map(self):
+        responses.add(
+            responses.GET, "http://example.com/api/countries/",
+            json=[
+                {"id": 4, "name": "Japan", "continent": "asia"},
+                {"id": 5, "name": "China", "continent": "asia"},
+            ],
+        )
+        responses.add(
+            responses.GET, "http://example.com/api/countries/4/",
+            json={"id": 4, "name": "Japan", "continent": "asia"},
+        )
+        list(MappedCountry.objects.all())
+        self.assertEqual(len(responses.calls), 1)
+
+        # listing records are not used for lookups when a detail URL is available
+        self.assertEqual(MappedCountry.objects.get(pk=4).name, "Japan")
+        self.assertEqual(len(responses.calls), 2)
+        self.assertEqual(MappedCountry.query_class().get(id=4).name, "Japan")
+        self.assertEqual(len(responses.calls), 2)
+
+        qs = MappedCountry.query_class()
+        qs.identity_map_accepts_list_records = True
+        result = qs.in_bulk([4, 5])
+        self.assertEqual(result[5].name, "China")
+        self.assertEqual(len(responses.calls), 2)
+
+    @responses.activate
+    def test_prefetch_related(self):
+        responses.add(
+            responses.GET, "http://example.com/api/cities/",
+            json=[
+                {"id": 1, "name": "Paris", "country_id": 1},
+                {"id": 2, "name": "Lyon", "country_id": 1},
+                {"id": 3, "name": "Tokyo", "country_id": 4},
+                {"id": 4, "name": "Atlantis", "country_id": None},
+            ],
+        )
+        responses.add(
+            responses.GET, "http://example.com/api/countries/",
+            match=[matchers.query_param_matcher({"id__in": "1,4"})],
+            json=[
+                {"id": 1, "name": "France", "continent": "europe"},
+                {"id": 4, "name": "Japan", "continent": "asia"},
+            ],
+        )
+        cities = list(City.objects.prefetch_related("country"))
+        self.assertEqual(
+            [(city.name, city.country and city.country.name) for city in cities],
+            [("Paris", "France"), ("Lyon", "France"), ("Tokyo", "Japan"), ("Atlantis", None)],
+        )
+        self.assertEqual(len(responses.calls), 2)
+
+        with self.assertRaises(ValueError):
+            City.objects.prefetch_related("mayor")
+
+    @responses.activate
+    def test_related_object_without_prefetch(self):
+        responses.add(
+            responses.GET, "http://example.com/api/countries/",
+            match=[matchers.query_param_matcher({"id": 4})],
+            json=[{"id": 4, "name": "Japan", "continent": "asia"}],
+        )
+        city = City.from_query_data({"id": 3, "name": "Tokyo", "country_id": 4})
+        self.assertEqual(city.country.name, "Japan")
+        self.assertEqual(city.country.name, "Japan")
+        self.assertEqual(len(responses.calls), 1)